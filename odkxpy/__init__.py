@@ -1,5 +1,5 @@
 from .odkx_connection import OdkxConnection
 from .odkx_server_meta import OdkxServerMeta
-from .odkx_local_table import OdkxLocalTable, LocalSyncMode
+from .odkx_local_table import OdkxLocalTable, LocalSyncMode, PullMode
 from .local_storage_sql import SqlLocalStorage
 from .odkx_migration import migrator
@@ -1,24 +1,83 @@
 import sqlalchemy
-from .odkx_server_table import OdkxServerTable, OdkxServerTableDefinition
+from .odkx_server_table import OdkxServerTable, OdkxServerTableDefinition, OdkxServerTableInfo
+from .odkx_server_meta import OdkxServerMeta
 from .odkx_local_table import OdkxLocalTable
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
-from typing import Optional, List
+from typing import Optional, List, Dict, Tuple
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 import os
+import time
+import logging
+import threading
+import hashlib
 
 
 class CacheNotFoundError(Exception):
     pass
 
 
+TableSyncResult = namedtuple('TableSyncResult', ['tableId', 'status', 'dataETag', 'seconds', 'error', 'report'])
+
+
 class SqlLocalStorage(object):
     chache_table_name = "odkxpy_cached_defintions"
 
-    def __init__(self, engine: sqlalchemy.engine.Engine, schema: str, file_storage_root: str, useWindowsCompatiblePaths: bool = False):
+    # indexes of the generated tables, by kind of table (see _createIndexes)
+    standard_indexes = {
+        'data': [['state']],
+        'log': [['id', 'savepointTimestamp']],
+        # rowETag is the primary key of staging. state of external staging is not indexed, it is rewritten on every row by localSync
+        # and an index on it would prevent HOT updates
+        'staging': [['id']],
+        'external': [['state']],
+        'external_staging': [['id']],
+        'rev': [['id']],
+        'status': [['table_name', 'sync_date']],
+    }
+
+    def __init__(self, engine: sqlalchemy.engine.Engine, schema: str, file_storage_root: str, useWindowsCompatiblePaths: bool = False,
+                 pullPrefetchPages: int = 0, pullPrefetchMaxRows: Optional[int] = None,
+                 attachmentWorkers: int = 1, attachmentHostConcurrency: Optional[int] = None, cacheAttachmentHashes: bool = True,
+                 pushBatchSize: int = 500, incrementalHashing: bool = False, extraIndexes: Optional[Dict[str, List[List[str]]]] = None,
+                 unloggedStaging: bool = False, pullPageSize: Optional[int] = None):
+        """
+        :param pullPrefetchPages: when > 0, diff pages are fetched in a background thread while the previous pages are written to staging.
+            this is the maximum number of pages waiting to be written
+        :param pullPrefetchMaxRows: maximum number of rows waiting to be written when prefetching (None is unlimited)
+        :param pullPageSize: number of rows requested per diff page (None uses the server default). a pull keeps at most
+            pullPrefetchPages + 2 pages in memory, whatever the size of the table
+        :param attachmentWorkers: number of rows whose attachments are synced concurrently
+        :param attachmentHostConcurrency: maximum number of rows synced concurrently against the same server host,
+            shared by all tables in this process that use the same limit (defaults to attachmentWorkers)
+        :param cacheAttachmentHashes: keep the md5 of the local attachments in the odkxpy_cached_md5 table,
+            so files are only hashed again when their size or modification time changed
+        :param pushBatchSize: number of rows sent to the server in one request when pushing local changes
+        :param incrementalHashing: maintain the hash column of external source tables with a trigger instead of
+            rehashing the whole table on every localSync
+        :param extraIndexes: additional indexes on business columns, by table name, eg {"my_table": [["region", "visit_date"]]}.
+            they are created together with the standard indexes of the table (see also addIndex)
+        :param unloggedStaging: make the staging tables UNLOGGED. they are emptied on every sync anyway, so this saves WAL volume
+            and replication traffic. their content is lost after a database crash (existing tables are converted when initialized)
+        """
         self.engine = engine
         self.schema = schema
         self.file_storage_root = file_storage_root
         self.useWindowsCompatiblePaths = useWindowsCompatiblePaths
+        self.pullPrefetchPages = pullPrefetchPages
+        self.pullPrefetchMaxRows = pullPrefetchMaxRows
+        self.pullPageSize = pullPageSize
+        self.attachmentWorkers = attachmentWorkers
+        self.attachmentHostConcurrency = attachmentHostConcurrency
+        self.cacheAttachmentHashes = cacheAttachmentHashes
+        self.pushBatchSize = pushBatchSize
+        self.incrementalHashing = incrementalHashing
+        self.unloggedStaging = unloggedStaging
+        self.extraIndexes: Dict[str, List[List[str]]] = {k: [list(x) for x in v] for k, v in (extraIndexes or {}).items()}
+        # reflected tables, keyed by (schema, table name)
+        self._tableMetaCache: Dict[Tuple[str, str], sqlalchemy.Table] = {}
+        self._tableMetaLock = threading.Lock()
         self._create_cache()
         self.Session = sessionmaker(bind=engine)
 
@@ -60,6 +119,7 @@ class SqlLocalStorage(object):
         # store defintion
         previous = session.query(table).filter_by(tableId = table_defintion.tableId).first()
         if not previous or previous.schemaETag != table_defintion.schemaETag:
+            self._invalidateTableMeta(prefix=table_defintion.tableId)
             session.merge(table(
                 tableId=table_defintion.tableId,
                 schemaETag=table_defintion.schemaETag,
@@ -81,6 +141,93 @@ class SqlLocalStorage(object):
         filestore = self._filestore_path(tableId)
         return OdkxLocalTable(tableId, self.engine, self.schema, filestore, useWindowsCompatiblePaths=self.useWindowsCompatiblePaths, storage=self)
 
+    def getLocalDataETags(self) -> Dict[str, str]:
+        """
+        the dataETag of the last sync of every local table, in one query
+        """
+        if self._getTableMetaOrNone('status_table') is None:
+            return {}
+        with self.engine.connect() as c:
+            rs = c.execute("""select distinct on (table_name) table_name, "dataETag" from {schema}.status_table
+                order by table_name, sync_date desc""".format(schema=self.schema))
+            return {r[0]: r[1] for r in rs}
+
+    def getChangedTables(self, meta: OdkxServerMeta, tableIds: Optional[List[str]] = None) -> List[OdkxServerTableInfo]:
+        """
+        the tables that changed on the server since their last sync (or were never synced), using one request to the server
+        and one query on the status table
+
+        :param tableIds: only check these tables (default: all tables of the server)
+        """
+        local_etags = self.getLocalDataETags()
+        return [x for x in meta.getTablesInfo() if (tableIds is None or x.tableId in tableIds)
+                and local_etags.get(x.tableId, '') != x.dataETag]
+
+    def _localTableFor(self, server_table: OdkxServerTable) -> OdkxLocalTable:
+        """
+        the local table, only initialized again when the schemaETag on the server differs from the cached definition
+        """
+        try:
+            if self.getCachedTableDefinition(server_table.tableId).schemaETag == server_table.schemaETag:
+                return self.getCachedLocalTable(server_table.tableId)
+        except CacheNotFoundError:
+            pass
+        return self.getLocalTable(server_table)
+
+    def syncAll(self, meta: OdkxServerMeta, tableIds: Optional[List[str]] = None, local_changes_prefix: Optional[str] = None,
+                workers: int = 4, **sync_options) -> List[TableSyncResult]:
+        """
+        sync all tables of the server (or only tableIds). the table list is fetched once, and tables whose dataETag did not change
+        and that have nothing to push and no pending attachments are skipped. the other tables are synced with a pool of workers.
+        a failing table does not stop the others, its exception is in the report.
+
+        :param meta: the server
+        :param local_changes_prefix: push the local changes of this external source, for the tables that have one
+        :param workers: number of tables synced at the same time
+        :param sync_options: passed to OdkxLocalTable.sync (eg no_attachments, pull_mode). trace_memory is ignored when more than one
+            worker is used, tracemalloc is process wide and the tables would see each other's allocations
+        :return: a TableSyncResult for every table, status is one of unchanged, synced or failed (synced tables have the SyncReport)
+        """
+        if sync_options.get('trace_memory') and workers > 1:
+            logging.warning("syncAll: trace_memory is not supported with more than one worker, disabled")
+            sync_options['trace_memory'] = False
+        infos = [x for x in meta.getTablesInfo() if tableIds is None or x.tableId in tableIds]
+        local_etags = self.getLocalDataETags()
+        results: Dict[str, TableSyncResult] = {}
+        todo = []
+        # table creation is not safe to run concurrently, so prepare the local tables first
+        for info in infos:
+            start = time.time()
+            server_table = OdkxServerTable(meta.connection, info.tableId, info.schemaETag)
+            try:
+                local_table = self._localTableFor(server_table)
+                prefix = local_changes_prefix
+                if prefix is not None and self._getTableMetaOrNone(info.tableId + '_' + prefix) is None:
+                    prefix = None
+                if local_etags.get(info.tableId, '') == info.dataETag and \
+                        not (prefix is not None and local_table.hasPendingLocalChanges(prefix)) and \
+                        not (not sync_options.get('no_attachments') and local_table.hasPendingAttachments()):
+                    results[info.tableId] = TableSyncResult(info.tableId, 'unchanged', info.dataETag, time.time() - start, None, None)
+                else:
+                    todo.append((info, server_table, local_table, prefix))
+            except Exception as e:
+                logging.exception("could not prepare table " + info.tableId)
+                results[info.tableId] = TableSyncResult(info.tableId, 'failed', None, time.time() - start, e, None)
+
+        def run(info, server_table, local_table, prefix):
+            start = time.time()
+            try:
+                report = local_table.sync(server_table, local_changes_prefix=prefix, remote_dataETag=info.dataETag, **sync_options)
+                return TableSyncResult(info.tableId, 'synced', local_table.getLocalDataETag(), time.time() - start, None, report)
+            except Exception as e:
+                logging.exception("sync of table " + info.tableId + " failed")
+                return TableSyncResult(info.tableId, 'failed', None, time.time() - start, e, None)
+
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            for result in executor.map(lambda x: run(*x), todo):
+                results[result.tableId] = result
+        return [results[x.tableId] for x in infos]
+
     def initializeLocalStorage(self, server_table: OdkxServerTable):
         tabledef = server_table.getTableDefinition()
         session = self.Session()
@@ -98,6 +245,11 @@ class SqlLocalStorage(object):
         self._createLocalTable(
             tabledef, log_table=True, table_name_instead=server_table.tableId + '_staging')
         self._createStatusTable()
+        self._setStagingPersistence(server_table.tableId + '_staging')
+        self._createIndexes(server_table.tableId, 'data')
+        self._createIndexes(server_table.tableId + '_log', 'log')
+        self._createIndexes(server_table.tableId + '_staging', 'staging')
+        self._createIndexes('status_table', 'status')
 
     def initializeExternalSource(self, source_prefix: str, server_table: OdkxServerTable, relevant_columns: Optional[List[str]] = None):
         """
@@ -121,11 +273,143 @@ class SqlLocalStorage(object):
                                create_state_col=True, only_create_datacols=relevant_columns)
         self._createLocalTable(tabledef, log_table=False, table_name_instead=server_table.tableId + '_' + source_prefix + '_staging',
                                create_hash_col=True, create_state_col=True, only_create_datacols=relevant_columns, no_create_standard_pkey=True)
+        self._setStagingPersistence(server_table.tableId + '_' + source_prefix + '_staging')
+        self._createIndexes(server_table.tableId + '_' + source_prefix, 'external')
+        self._createIndexes(server_table.tableId + '_' + source_prefix + '_staging', 'external_staging')
+
+    def _setStagingPersistence(self, tablename: str):
+        """
+        convert a staging table to UNLOGGED (or back to a normal table) according to unloggedStaging
+        """
+        with self.engine.begin() as c:
+            persistence = c.execute(sqlalchemy.text("""select c.relpersistence from pg_class c
+                join pg_namespace n on n.oid = c.relnamespace where n.nspname = :schema and c.relname = :name"""),
+                                    schema=self.schema, name=tablename).scalar()
+            if persistence == 'p' and self.unloggedStaging:
+                c.execute("""ALTER TABLE {schema}."{table}" SET UNLOGGED""".format(schema=self.schema, table=tablename))
+            elif persistence == 'u' and not self.unloggedStaging:
+                c.execute("""ALTER TABLE {schema}."{table}" SET LOGGED""".format(schema=self.schema, table=tablename))
+
+    def _indexName(self, tablename: str, columns: List[str]) -> str:
+        name = 'ix_' + tablename + '_' + '_'.join(columns)
+        if len(name) > 63:
+            # postgresql truncates longer identifiers, which could make different indexes collide
+            name = 'ix_' + tablename[:40] + '_' + hashlib.md5(name.encode('utf-8')).hexdigest()[:16]
+        return name
+
+    def _indexValid(self, connection, name: str) -> Optional[bool]:
+        """
+        :return: None when the index does not exist, False when it is invalid (eg an interrupted CREATE INDEX CONCURRENTLY)
+        """
+        return connection.execute(sqlalchemy.text("""select i.indisvalid from pg_index i
+            join pg_class c on c.oid = i.indexrelid join pg_namespace n on n.oid = c.relnamespace
+            where n.nspname = :schema and c.relname = :name"""), schema=self.schema, name=name).scalar()
+
+    def _indexBuilding(self, connection, name: str, tablename: str) -> bool:
+        """
+        :return: True when another backend is working on the index. a CREATE INDEX CONCURRENTLY locks the index while it builds it,
+            and holds a SHARE UPDATE EXCLUSIVE lock on the table from start to end
+        """
+        return connection.execute(sqlalchemy.text("""select exists(select 1 from pg_locks l
+            where l.pid <> pg_backend_pid() and l.database = (select oid from pg_database where datname = current_database())
+            and (l.relation = to_regclass(:index) or (l.relation = to_regclass(:table) and l.mode = 'ShareUpdateExclusiveLock')))"""),
+                                  index='{s}."{n}"'.format(s=self.schema, n=name),
+                                  table='{s}."{t}"'.format(s=self.schema, t=tablename)).scalar()
+
+    def _waitForIndex(self, connection, name: str, tablename: str) -> Optional[bool]:
+        """
+        wait until no other backend is building the index (an invalid index can be a build that is still running)
+
+        :return: the validity of the index afterwards, see _indexValid
+        """
+        valid = self._indexValid(connection, name)
+        while valid is False and self._indexBuilding(connection, name, tablename):
+            time.sleep(1)
+            valid = self._indexValid(connection, name)
+        return valid
+
+    def ensureIndex(self, tablename: str, columns: List[str], unique: bool = False):
+        """
+        create an index if it does not exist yet. the index is built CONCURRENTLY, so this can run while the table is in use
+        and from several processes at the same time
+        """
+        name = self._indexName(tablename, columns)
+        with self.engine.connect() as c:
+            c = c.execution_options(isolation_level="AUTOCOMMIT")
+            valid = self._waitForIndex(c, name, tablename)
+            if valid:
+                return
+            if valid is not None:
+                # invalid and nobody is building it: left over from an interrupted build
+                c.execute("""DROP INDEX CONCURRENTLY IF EXISTS {schema}."{name}" """.format(schema=self.schema, name=name))
+            try:
+                # IF NOT EXISTS: when another process started the same build in the meantime, this does nothing
+                c.execute("""CREATE {unique}INDEX CONCURRENTLY IF NOT EXISTS "{name}" ON {schema}."{table}" ({cols})""".format(
+                    unique='UNIQUE ' if unique else '', name=name, schema=self.schema, table=tablename,
+                    cols=','.join(['"{c}"'.format(c=x) for x in columns])))
+            except sqlalchemy.exc.DBAPIError:
+                # somebody else created or dropped it at the same time
+                if not self._waitForIndex(c, name, tablename):
+                    raise
+
+    def addIndex(self, tablename: str, columns: List[str]):
+        """
+        declare an extra index on a local table. it is created now (if the table exists) and whenever the table is initialized
+        """
+        declared = self.extraIndexes.setdefault(tablename, [])
+        if list(columns) not in declared:
+            declared.append(list(columns))
+        self._createIndexes(tablename)
+
+    def _createIndexes(self, tablename: str, kind: Optional[str] = None):
+        """
+        create the standard indexes for this kind of table and the extra indexes declared for it,
+        skipping indexes on columns the table does not have
+        """
+        t = self._getTableMetaOrNone(tablename)
+        if t is None:
+            # table does not exist (yet)
+            return
+        for columns in self.standard_indexes.get(kind, []) + self.extraIndexes.get(tablename, []):
+            if all(c in t.c for c in columns):
+                self.ensureIndex(tablename, columns)
 
     def _getTableMeta(self, tablename: str) -> sqlalchemy.Table:
+        """
+        the reflected table, cached until the table is changed through this storage (treat it as read-only)
+        """
+        key = (self.schema, tablename)
+        with self._tableMetaLock:
+            if key in self._tableMetaCache:
+                return self._tableMetaCache[key]
         meta = sqlalchemy.MetaData()
         meta.reflect(self.engine, schema=self.schema, only=[tablename])
-        return meta.tables.get(self.schema + '.' + tablename)
+        t = meta.tables.get(self.schema + '.' + tablename)
+        if t is not None:
+            with self._tableMetaLock:
+                self._tableMetaCache[key] = t
+        return t
+
+    def _getTableMetaOrNone(self, tablename: str) -> Optional[sqlalchemy.Table]:
+        try:
+            return self._getTableMeta(tablename)
+        except sqlalchemy.exc.InvalidRequestError:
+            return None
+
+    def _invalidateTableMeta(self, tablename: Optional[str] = None, prefix: Optional[str] = None):
+        """
+        forget cached reflections: of one table, of a table and all tables named [prefix]_..., or everything
+        """
+        with self._tableMetaLock:
+            if tablename is None and prefix is None:
+                self._tableMetaCache.clear()
+                return
+            for key in list(self._tableMetaCache.keys()):
+                schema, name = key
+                if schema != self.schema:
+                    continue
+                if name == tablename or (prefix is not None and (name == prefix or name.startswith(prefix + '_'))):
+                    del self._tableMetaCache[key]
 
     def _createStatusTable(self):
         s_tn = 'status_table'
@@ -145,6 +429,7 @@ class SqlLocalStorage(object):
         t.append_column(sqlalchemy.Column('dataETag', sqlalchemy.String(50)))
         t.append_column(sqlalchemy.Column('sync_date', sqlalchemy.DateTime))
         meta.create_all()
+        self._invalidateTableMeta(s_tn)
 
     def _createRevisionTable(self, historyTable):
         s_tn = historyTable + "_rev"
@@ -163,6 +448,8 @@ class SqlLocalStorage(object):
         t.append_column(sqlalchemy.Column('id', sqlalchemy.String(50)))
         t.append_column(sqlalchemy.Column('rowETag', sqlalchemy.String(50)))
         meta.create_all()
+        self._invalidateTableMeta(s_tn)
+        self._createIndexes(s_tn, 'rev')
 
     def _createLocalTable(self, server_table: OdkxServerTableDefinition, log_table: bool = False, table_name_instead=None,
                           create_hash_col: bool = False, create_state_col: bool = False, only_create_datacols: Optional[List[str]] = None,
@@ -182,6 +469,7 @@ class SqlLocalStorage(object):
                 t = meta.tables.get(full_tn)  # sqlalchemy.Table
         except sqlalchemy.exc.InvalidRequestError:
             t = sqlalchemy.Table(s_tn, meta, schema=self.schema)
+        existing_cols = len(t.c)
 
         definition = server_table.columns
         column_names = [x.elementKey for x in definition if x.isMaterialized()]
@@ -249,3 +537,5 @@ class SqlLocalStorage(object):
                 50), primary_key=pkey, nullable=nullable))
 
         meta.create_all(self.engine)
+        if len(t.c) != existing_cols:
+            self._invalidateTableMeta(s_tn)
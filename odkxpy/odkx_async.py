@@ -0,0 +1,251 @@
+"""
+asyncio versions of OdkxConnection, OdkxServerTable and OdkxServerMeta, on aiohttp (pip install odkxpy[async])
+all requests of one connection share a session, so many diff pages, manifests or attachments can be fetched concurrently
+(eg with asyncio.gather) on one event loop
+"""
+import json
+import asyncio
+import logging
+import aiohttp
+from typing import Any, AsyncGenerator, Dict, List, Optional, Sequence, Union
+from .odkx_server_file import OdkxServerFile, OdkxServerFileManifest
+from .odkx_server_meta import OdkxServerUser
+from .odkx_server_table import OdkxServerTable, OdkxServerTableDefinition, OdkxServerTableInfo, OdkxServerTableRowset
+
+
+class AsyncOdkxConnection(object):
+    """
+    asyncio connection to a ODK-X sync endpoint REST API. use it as an async context manager, or call close() when done
+
+    :param limit: maximum number of simultaneous connections
+    :param timeout: total timeout of a request in seconds (None is no timeout)
+    """
+    def __init__(self, server, user, pwd, proxy=None, appID="default", limit: int = 100, timeout: Optional[float] = None):
+        self.user = user
+        self.pwd = pwd
+        self.appID = appID
+        self.server = server
+        self.proxy = proxy
+        self.limit = limit
+        self.timeout = timeout
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        # created on first use, a ClientSession has to be created inside the event loop
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(auth=aiohttp.BasicAuth(self.user, self.pwd),
+                                                  connector=aiohttp.TCPConnector(limit=self.limit),
+                                                  timeout=aiohttp.ClientTimeout(total=self.timeout))
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    def _url(self, url: str) -> str:
+        return self.server + self.appID + '/' + url
+
+    @staticmethod
+    def _params(params: Optional[Dict[str, Any]]) -> Optional[Dict[str, str]]:
+        # like requests: leave out None values and send the other values as strings
+        if params is None:
+            return None
+        return {k: str(v) for k, v in params.items() if v is not None}
+
+    async def treatResponse(self, response: aiohttp.ClientResponse):
+        body = await response.read()
+        logging.debug("HTTP status: \033[92m[" + str(response.status) + ']\033[0m - ' + str(response.url))
+        if (response.status == 200) and body:
+            output = json.loads(body)
+        elif str(response.status).startswith("2"):
+            output = response
+        else:
+            raise Exception("HTTP {code} {content}".format(code=response.status, content=body))
+        return output
+
+    def request(self, method: str, url: str, params=None, **kwargs):
+        """
+        the raw request, to use as "async with con.request(...) as response" (eg to stream the body with response.content)
+        """
+        return self.session.request(method, self._url(url), params=self._params(params), proxy=self.proxy, **kwargs)
+
+    async def PUT(self, url, data_):
+        headers = {'Content-Type': 'application/json'}
+        async with self.request('PUT', url, headers=headers, data=json.dumps(data_)) as response:
+            return await self.treatResponse(response)
+
+    async def GET(self, url, params=None):
+        async with self.request('GET', url, params=params) as response:
+            return await self.treatResponse(response)
+
+    async def POST(self, url, data, headers=None):
+        async with self.request('POST', url, headers=headers, data=data) as response:
+            return await self.treatResponse(response)
+
+    async def DELETE(self, url):
+        async with self.request('DELETE', url) as response:
+            return await self.treatResponse(response)
+
+
+class AsyncOdkxServerTable(object):
+    """
+    asyncio version of OdkxServerTable. to get a table, use AsyncOdkxServerMeta
+    """
+
+    def __init__(self, con: AsyncOdkxConnection, tableId: str, schemaETag: str):
+        self.connection = con
+        self.tableId = tableId
+        self.schemaETag = schemaETag
+
+    def getTableRoot(self):
+        return "tables/" + self.tableId
+
+    def getTableDefinitionRoot(self):
+        return self.getTableRoot() + "/ref/" + self.schemaETag
+
+    def getTableFilesRoot(self):
+        return 'files/2/tables/' + self.tableId
+
+    def _safePath(self, path):
+        return ('' if path.startswith('/') else '/') + path
+
+    async def getTableInfo(self) -> OdkxServerTableInfo:
+        return OdkxServerTableInfo(**await self.connection.GET(self.getTableRoot()))
+
+    async def getdataETag(self):
+        return (await self.getTableInfo()).dataETag
+
+    async def getFileManifest(self) -> List[OdkxServerFile]:
+        return [OdkxServerFile(**x) for x in (await self.connection.GET("manifest/2/" + self.tableId))['files']]
+
+    async def getFile(self, path):
+        return await self.connection.GET(self.getTableFilesRoot() + self._safePath(path))
+
+    async def getTableDefinition(self) -> OdkxServerTableDefinition:
+        t_d, properties = await asyncio.gather(self.connection.GET(self.getTableDefinitionRoot()),
+                                               self.connection.GET("tables/" + self.tableId + "/properties/2"))
+        return OdkxServerTableDefinition._from_server(self.tableId, t_d, properties)
+
+    async def getTableProperties(self):
+        return await self.connection.GET('tables/' + self.tableId + "/properties/2")
+
+    async def getDiff(self, dataETag=None, cursor=None, fetchLimit=None, getFullLog=False, raw=False) -> OdkxServerTableRowset:
+        params = {'data_etag': dataETag,
+                  'cursor': cursor, 'fetchLimit': fetchLimit, 'getFullLog': getFullLog}
+        r = await self.connection.GET(self.getTableDefinitionRoot() + "/diff", params)
+        return OdkxServerTable._parse_rowset(r, raw)
+
+    async def getDiffGenerator(self, dataETag=None, fetchLimit=None, getFullLog=False, cursor=None,
+                               raw=False) -> AsyncGenerator[OdkxServerTableRowset, None]:
+        hasmore = True
+        while hasmore:
+            rs = await self.getDiff(dataETag=dataETag, cursor=cursor, fetchLimit=fetchLimit, getFullLog=getFullLog, raw=raw)
+            hasmore = rs.hasMoreResults
+            cursor = rs.webSafeResumeCursor
+            yield rs
+
+    async def getAllDataRows(self, cursor=None, fetchLimit=None, raw=False) -> OdkxServerTableRowset:
+        params = {'cursor': cursor, 'fetchLimit': fetchLimit}
+        return OdkxServerTable._parse_rowset(await self.connection.GET(self.getTableDefinitionRoot() + "/rows", params), raw)
+
+    async def getAllDataRowsGenerator(self, fetchLimit=None, cursor=None, raw=False) -> AsyncGenerator[OdkxServerTableRowset, None]:
+        hasmore = True
+        while hasmore:
+            rs = await self.getAllDataRows(cursor=cursor, fetchLimit=fetchLimit, raw=raw)
+            hasmore = rs.hasMoreResults
+            cursor = rs.webSafeResumeCursor
+            yield rs
+
+    async def getDataRow(self, rowId, raw=False):
+        r = await self.connection.GET(self.getTableDefinitionRoot() + "/rows/" + rowId)
+        if raw:
+            return r
+        return OdkxServerTable._parse_row(r)
+
+    async def alterDataRows(self, json):
+        """Insert, Update or Delete"""
+        return await self.connection.PUT(self.getTableDefinitionRoot() + "/rows", json)
+
+    async def getAttachmentsManifest(self, rowId: str) -> Sequence[OdkxServerFile]:
+        url_frament = self.getTableDefinitionRoot() + "/attachments/" + rowId + "/manifest"
+        return [OdkxServerFile(**d) for d in (await self.connection.GET(url_frament))['files']]
+
+    async def getAttachment(self, rowId, name) -> bytes:
+        async with self.openAttachment(rowId, name) as response:
+            if response.status != 200:
+                await self.connection.treatResponse(response)
+            return await response.read()
+
+    def openAttachment(self, rowId, name):
+        """
+        stream one attachment: "async with table.openAttachment(rowId, name) as response", then read response.content in chunks
+        """
+        return self.connection.request('GET', self.getTableDefinitionRoot() + "/attachments/" + rowId + "/file/" + name)
+
+    def getAttachments(self, rowId: str, manifest: Sequence[OdkxServerFile]):
+        """
+        the multipart response with the files of the manifest, to use as "async with" (see openAttachment)
+        """
+        payload = OdkxServerFileManifest(manifest).asdict()
+        return self.connection.request('POST', self.getTableDefinitionRoot() + "/attachments/" + rowId + "/download", json=payload)
+
+    async def putAttachment(self, rowId, name, data: bytes):
+        headers = {"Content-Type": "application/octet-stream"}
+        return await self.connection.POST(self.getTableDefinitionRoot() + "/attachments/" + rowId + "/file/" + name,
+                                          data, headers=headers)
+
+    async def putAttachments(self, rowId, manifest: Sequence["OdkxLocalFile"], data: List[Union[bytes, Any]]):
+        """
+        :param manifest: ex. FilesystemAttachmentStore().getManifest(rowId)
+        :param data: list of byte arrays or open binary files. files are streamed, the caller closes them afterwards
+        """
+        multi = aiohttp.MultipartWriter('form-data')
+        for srv, d in zip(manifest, data):
+            part = multi.append(d, {'Content-Type': srv.contentType or "image/jpg", 'Name': 'file'})
+            # odkx-sync-endpoint uses the custom content disposition "file"
+            part.set_content_disposition('file', name=srv.filename, filename=srv.filename)
+        return await self.connection.POST(self.getTableDefinitionRoot() + "/attachments/" + rowId + "/upload", multi)
+
+
+class AsyncOdkxServerMeta(object):
+    """
+    asyncio version of OdkxServerMeta
+    """
+    def __init__(self, connection: AsyncOdkxConnection):
+        self.connection = connection
+
+    async def getSupportedClientVersions(self):
+        return await self.connection.GET('clientVersions')
+
+    async def getPrivilegesInfo(self):
+        return OdkxServerUser(**await self.connection.GET('privilegesInfo'))
+
+    async def getUsersInfo(self):
+        return [OdkxServerUser(**x) for x in await self.connection.GET('usersInfo')]
+
+    async def getFileManifest(self):
+        return [OdkxServerFile(**d) for d in (await self.connection.GET("manifest/2/"))['files']]
+
+    async def getFile(self, path):
+        return await self.connection.GET('files/2' + ('' if path.startswith('/') else '/') + path)
+
+    async def getTables(self) -> List[AsyncOdkxServerTable]:
+        return [AsyncOdkxServerTable(self.connection, x['tableId'], x['schemaETag']) for x in (await self.connection.GET("tables"))['tables']]
+
+    async def getTablesInfo(self) -> List[OdkxServerTableInfo]:
+        return [OdkxServerTableInfo(**x) for x in (await self.connection.GET("tables"))['tables']]
+
+    async def getTable(self, tableId: str) -> AsyncOdkxServerTable:
+        tables = await self.getTables()
+        table = next((table for table in tables if table.tableId == tableId), None)
+        if table:
+            return table
+        raise Exception("Unknown table. Not found in :" + str([tb.tableId for tb in tables]))
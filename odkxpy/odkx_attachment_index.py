@@ -0,0 +1,72 @@
+"""
+Persistent index of the md5 hashes of local attachment files
+an entry is only valid as long as the size and modification time of the file did not change
+"""
+import threading
+import sqlalchemy
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from typing import Dict, Optional, Tuple, TYPE_CHECKING
+if TYPE_CHECKING:
+    from .local_storage_sql import SqlLocalStorage
+
+
+def md5cache_class(base):
+    class CachedMD5(base):
+        __tablename__ = "odkxpy_cached_md5"
+        tableId = sqlalchemy.Column(sqlalchemy.String, primary_key=True)
+        rowId = sqlalchemy.Column(sqlalchemy.String, primary_key=True)
+        filename = sqlalchemy.Column(sqlalchemy.String, primary_key=True)
+        size = sqlalchemy.Column(sqlalchemy.BigInteger)
+        mtime = sqlalchemy.Column(sqlalchemy.BigInteger)
+        md5hash = sqlalchemy.Column(sqlalchemy.String)
+
+    return CachedMD5
+
+
+class AttachmentHashIndex(object):
+    """
+    md5 cache for the attachments of one table, stored in the local schema.
+    the entries of a row are loaded the first time that row is looked up.
+
+    :param storage: the local storage (the cache table is created in its schema)
+    :param tableId: the table the attachments belong to
+    """
+    def __init__(self, storage: "SqlLocalStorage", tableId: str):
+        self.engine = storage.engine
+        self.tableId = tableId
+        self.CachedMD5 = md5cache_class(storage.declarative_base())
+        self.CachedMD5.__table__.create(bind=self.engine, checkfirst=True)
+        self._rows: Dict[str, Dict[str, Tuple[int, int, str]]] = {}
+        self._lock = threading.Lock()
+
+    def _load(self, rowId: str) -> Dict[str, Tuple[int, int, str]]:
+        with self._lock:
+            if rowId in self._rows:
+                return self._rows[rowId]
+        t = self.CachedMD5.__table__
+        with self.engine.connect() as c:
+            rs = c.execute(sqlalchemy.select([t.c.filename, t.c.size, t.c.mtime, t.c.md5hash])
+                           .where(t.c.tableId == self.tableId).where(t.c.rowId == rowId))
+            entries = {r[0]: (r[1], r[2], r[3]) for r in rs}
+        with self._lock:
+            return self._rows.setdefault(rowId, entries)
+
+    def get(self, rowId: str, filename: str, size: int, mtime: int) -> Optional[str]:
+        """
+        :return: the cached md5, or None when the file is unknown or its size/mtime changed
+        """
+        entry = self._load(rowId).get(filename)
+        if entry is not None and entry[0] == size and entry[1] == mtime:
+            return entry[2]
+        return None
+
+    def put(self, rowId: str, filename: str, size: int, mtime: int, md5hash: str):
+        t = self.CachedMD5.__table__
+        qry = pg_insert(t).values(tableId=self.tableId, rowId=rowId, filename=filename, size=size, mtime=mtime, md5hash=md5hash)
+        qry = qry.on_conflict_do_update(index_elements=[t.c.tableId, t.c.rowId, t.c.filename],
+                                        set_=dict(size=size, mtime=mtime, md5hash=md5hash))
+        with self.engine.begin() as c:
+            c.execute(qry)
+        entries = self._load(rowId)
+        with self._lock:
+            entries[filename] = (size, mtime, md5hash)
@@ -0,0 +1,98 @@
+"""
+Attachment synchronisation for the rows of a local table that are in state "sync_attachments"
+rows are handled by a pool of worker threads, the number of concurrent requests per server host is limited
+"""
+import logging
+import threading
+import contextvars
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, List, Optional, Tuple, TYPE_CHECKING
+from urllib.parse import urlparse
+from .odkx_server_table import OdkxServerTable
+if TYPE_CHECKING:
+    from .odkx_local_table import OdkxLocalTable
+
+AttachmentSyncResult = namedtuple('AttachmentSyncResult', ['synced', 'failed'])
+
+
+class AttachmentSyncEngine(object):
+    """
+    :param localTable: the local table doing the actual downloads/uploads
+    :param remoteTable: the server table
+    :param table: name of the local table containing the state column
+    :param state_col: the state column to set to 'synced'
+    :param workers: number of rows handled concurrently
+    :param host_concurrency: maximum number of rows handled concurrently for one server host (shared by all engines in this process
+        that use the same limit)
+    :param flush_size: number of successful rows written back in one UPDATE
+    """
+    # keyed by (host, limit), so an engine is never held to the limit of another one
+    _host_semaphores: Dict[Tuple[str, int], threading.BoundedSemaphore] = {}
+    _host_lock = threading.Lock()
+
+    def __init__(self, localTable: "OdkxLocalTable", remoteTable: OdkxServerTable, table: str, state_col: str = "state",
+                 workers: int = 1, host_concurrency: Optional[int] = None, flush_size: int = 100):
+        self.localTable = localTable
+        self.remoteTable = remoteTable
+        self.table = table
+        self.state_col = state_col
+        self.workers = max(1, workers)
+        self.host_concurrency = host_concurrency or self.workers
+        self.flush_size = flush_size
+        self._semaphore = self._hostSemaphore(urlparse(remoteTable.connection.server).netloc)
+
+    def _hostSemaphore(self, host: str) -> threading.BoundedSemaphore:
+        with self._host_lock:
+            key = (host, self.host_concurrency)
+            if key not in self._host_semaphores:
+                self._host_semaphores[key] = threading.BoundedSemaphore(self.host_concurrency)
+            return self._host_semaphores[key]
+
+    def _syncRow(self, mode: str, id: str, files: List[str]) -> bool:
+        try:
+            with self._semaphore:
+                if mode == "pushing":
+                    return self.localTable.uploadAttachments(self.remoteTable, id, files)
+                return self.localTable.downloadAttachments(self.remoteTable, id, files)
+        except Exception:
+            logging.exception("attachment sync failed for %s (trying again on next sync)", id)
+            return False
+
+    def _flush(self, ids: List[str]):
+        if ids:
+            self.localTable._writeSuccessBatch(self.table, ids, self.state_col)
+
+    def run(self, mode: str, ids: List[str], files_by_id: Dict[str, List[str]]) -> AttachmentSyncResult:
+        """
+        :param mode: "pushing" or "pulling"
+        :param ids: the row ids to sync
+        :param files_by_id: for every row id, the attachments that should exist for this row
+        """
+        synced = []
+        failed = []
+        pending = []
+
+        def done(id, ok):
+            if ok:
+                synced.append(id)
+                pending.append(id)
+                if len(pending) >= self.flush_size:
+                    self._flush(pending)
+                    pending.clear()
+            else:
+                failed.append(id)
+
+        try:
+            if self.workers == 1:
+                for id in ids:
+                    done(id, self._syncRow(mode, id, files_by_id[id]))
+            else:
+                with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="odkxpy-attachments") as pool:
+                    # in a copy of the caller's context, so the requests count in the bytes of its SyncReport phase
+                    futures = {pool.submit(contextvars.copy_context().run, self._syncRow, mode, id, files_by_id[id]): id for id in ids}
+                    for fut in as_completed(futures):
+                        done(futures[fut], fut.result())
+        finally:
+            self._flush(pending)
+        return AttachmentSyncResult(synced, failed)
@@ -0,0 +1,136 @@
+"""
+Bulk loading of rows into local tables
+uses postgresql COPY FROM STDIN when the dbapi driver supports it (psycopg2), otherwise falls back to executemany batches
+"""
+import json
+import itertools
+import sqlalchemy
+from sqlalchemy.dialects import postgresql
+from typing import Optional, Callable, Any, Iterable, Iterator, Sequence
+from .odkx_server_table import OdkxServerTableDefinition
+
+
+def _copy_escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+class _CopyStream(object):
+    """
+    file-like object that renders the lines for COPY while the driver reads them, so a batch is never held in memory as text
+    """
+    def __init__(self, lines: Iterator[str]):
+        self._lines = lines
+        self._buffer = ''
+
+    def read(self, size: int = -1) -> str:
+        parts = [self._buffer]
+        length = len(self._buffer)
+        for line in self._lines:
+            parts.append(line)
+            length += len(line)
+            if 0 <= size <= length:
+                break
+        data = ''.join(parts)
+        if 0 <= size < len(data):
+            self._buffer = data[size:]
+            return data[:size]
+        self._buffer = ''
+        return data
+
+    def readline(self, size: int = -1) -> str:
+        if self._buffer:
+            data, self._buffer = self._buffer, ''
+            return data
+        return next(self._lines, '')
+
+
+class OdkxBulkLoader(object):
+    """
+    writes rows (sequences of values in the order of columns, eg the output of OdkxRowConverter.asvalues) into a local table.
+
+    :param table: the (reflected) target table
+    :param definition: the table definition, used to type the data columns
+    :param batch_size: number of rows per executemany batch when COPY is not available
+    """
+    def __init__(self, table: sqlalchemy.Table, definition: Optional[OdkxServerTableDefinition] = None, batch_size: int = 1000):
+        self.table = table
+        self.batch_size = batch_size
+        self.columns = [c.name for c in table.columns]
+        types = {}
+        if definition is not None:
+            types = {c.elementKey: c.elementType for c in definition.columns if c.isMaterialized()}
+        self._converters = [self._converter(c, types.get(c.name)) for c in table.columns]
+
+    def _converter(self, column: sqlalchemy.Column, elementType: Optional[str]) -> Callable[[Any], Optional[str]]:
+        """
+        build the function that renders one value of this column in COPY text format (None means NULL)
+        """
+        if isinstance(column.type, sqlalchemy.types.JSON):
+            # exactly what the insert of _executemany stores: the json bind processor also encodes strings (the server sends
+            # arrays as strings, so they are stored as json strings) and None (json null)
+            process = column.type.bind_processor(postgresql.dialect()) or json.dumps
+
+            def conv(v):
+                v = process(v)
+                if v is None:
+                    return None
+                return _copy_escape(v)
+        elif elementType in ('number', 'integer'):
+            def conv(v):
+                if v is None or v == '':
+                    return None
+                return _copy_escape(str(v))
+        else:
+            def conv(v):
+                if v is None:
+                    return None
+                if isinstance(v, bool):
+                    return 't' if v else 'f'
+                return _copy_escape(str(v))
+        return conv
+
+    def _copy_cursor(self, connection: sqlalchemy.engine.Connection):
+        if connection.dialect.name != 'postgresql':
+            return None
+        cursor = connection.connection.cursor()
+        if not hasattr(cursor, 'copy_expert'):
+            cursor.close()
+            return None
+        return cursor
+
+    def _lines(self, rows: Iterable[Sequence]) -> Iterator[str]:
+        for row in rows:
+            line = []
+            for value, conv in zip(row, self._converters):
+                v = conv(value)
+                line.append('\\N' if v is None else v)
+            yield '\t'.join(line) + '\n'
+
+    def _copy(self, cursor, rows: Iterable[Sequence]):
+        sql = 'COPY {schema}"{table}" ({cols}) FROM STDIN'.format(
+            schema=(self.table.schema + '.') if self.table.schema else '',
+            table=self.table.name,
+            cols=','.join(['"{c}"'.format(c=c) for c in self.columns]))
+        cursor.copy_expert(sql, _CopyStream(self._lines(rows)))
+
+    def _executemany(self, connection: sqlalchemy.engine.Connection, rows: Iterable[Sequence]):
+        rows = iter(rows)
+        while True:
+            batch = [dict(zip(self.columns, row)) for row in itertools.islice(rows, self.batch_size)]
+            if not batch:
+                return
+            connection.execute(self.table.insert(), batch)
+
+    def loadValues(self, connection: sqlalchemy.engine.Connection, rows: Iterable[Sequence]):
+        """
+        insert rows given as sequences of values in the order of columns. rows can be a generator, it is consumed while
+        the data is sent to the database
+        """
+        cursor = self._copy_cursor(connection)
+        if cursor is None:
+            self._executemany(connection, rows)
+            return
+        try:
+            self._copy(cursor, rows)
+        finally:
+            cursor.close()
@@ -2,6 +2,17 @@ import requests
 import json
 import datetime
 import logging
+import time
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib.parse import urlencode
+from typing import Optional, Union, Tuple
+from .odkx_response_cache import ResponseCache, ResponseCacheEntry
+from .odkx_instrumentation import RequestMetrics
+
+# retried when retries > 0. only idempotent reads are retried, a PUT of rows could be applied twice
+RETRY_STATUSES = (429, 502, 503, 504)
+RETRY_METHODS = frozenset(['GET', 'HEAD'])
 
 
 class OdkxConnection(object):
@@ -9,15 +20,83 @@ class OdkxConnection(object):
     This is a connection to a ODK-X sync endpoint REST API
     TODO : implement client version support
     """
-    def __init__(self, server, user, pwd, proxies=None, appID="default"):
+    def __init__(self, server, user, pwd, proxies=None, appID="default", pool_connections: int = 10, pool_maxsize: int = 10,
+                 pool_block: bool = False, retries: Union[int, Retry] = 0, backoff_factor: float = 0,
+                 timeout: Optional[Union[float, Tuple[float, float]]] = None, keep_alive: bool = True,
+                 cache: Optional[ResponseCache] = None, metrics: Optional[RequestMetrics] = None):
+        """
+        the session can be shared by several threads (eg SqlLocalStorage.syncAll or attachmentWorkers)
+
+        :param pool_connections: number of hosts to keep a connection pool for
+        :param pool_maxsize: number of connections kept open per host, should be at least the number of threads using this connection
+        :param pool_block: wait for a free connection instead of opening (and then throwing away) an extra one when the pool is full
+        :param retries: number of retries of GET requests after a connection error or a 429/502/503/504 status,
+            or a urllib3 Retry for full control
+        :param backoff_factor: sleep backoff_factor * 2 ** (retry number - 1) seconds between retries
+        :param timeout: default timeout of a request in seconds, or a (connect, read) tuple (None is no timeout)
+        :param keep_alive: reuse connections between requests
+        :param cache: keep definitions, properties, manifests and files in this cache (a FileResponseCache or SqlResponseCache)
+            and only download them again when they changed on the server
+        :param metrics: record the latency, bytes and status of every request (see RequestMetrics)
+        """
         self.user = user
         self.pwd = pwd
         self.appID = appID
         self.server = server
         self.proxies = proxies
+        self.timeout = timeout
+        self.cache = cache
+        self.metrics = metrics
         self.session = requests.session()
         self.session.proxies = proxies
         self.session.auth = (self.user, self.pwd)
+        if isinstance(retries, int) and retries > 0:
+            retries = Retry(total=retries, backoff_factor=backoff_factor, status_forcelist=RETRY_STATUSES,
+                            allowed_methods=RETRY_METHODS, raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize, max_retries=retries, pool_block=pool_block)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        if not keep_alive:
+            self.session.headers['Connection'] = 'close'
+
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        """
+        send a request to url (relative to the app root), with the default timeout unless one is given
+        """
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        if self.metrics is None:
+            return self.session.request(method, self.server + self.appID + '/' + url, **kwargs)
+        start = time.perf_counter()
+        try:
+            response = self.session.request(method, self.server + self.appID + '/' + url, **kwargs)
+        except Exception:
+            self.metrics.record(method, url, None, time.perf_counter() - start, 0, 0)
+            raise
+        # a streamed body is not read yet: its duration is the time until the headers, its bytes are counted while it is read
+        if kwargs.get('stream'):
+            received = 0
+            self._countStream(response, method, url)
+        else:
+            received = len(response.content)
+        sent = int(response.request.headers.get('Content-Length') or 0)
+        self.metrics.record(method, url, response.status_code, time.perf_counter() - start, sent, received)
+        return response
+
+    def _countStream(self, response: requests.Response, method: str, url: str):
+        """
+        count the bytes of a streamed response as they are read with iter_content (response.content and iter_lines use it as well)
+        """
+        iter_content = response.iter_content
+        metrics = self.metrics
+
+        def counting_iter_content(*args, **kwargs):
+            for chunk in iter_content(*args, **kwargs):
+                if isinstance(chunk, bytes):
+                    metrics.recordReceived(method, url, len(chunk))
+                yield chunk
+
+        response.iter_content = counting_iter_content
 
     def treatResponse(self, response):
         logging.debug("HTTP status: \033[92m[" + str(response.status_code) + ']\033[0m - ' + response.url)
@@ -35,25 +114,51 @@ class OdkxConnection(object):
         """
         headers = {'Content-Type': 'application/json'}
         payload = json.dumps(data_)
-        response = self.session.put(self.server+self.appID+'/'+url, headers=headers, data=payload)
+        response = self.request('PUT', url, headers=headers, data=payload)
         return self.treatResponse(response)
 
     def GET(self, url, params=None, stream=False, timeout=None):
         """fetch tables through HTTP GET
         """
-        response = self.session.get(self.server+self.appID+'/'+url, params=params, stream=stream, timeout=timeout)
+        if self.cache is not None and not stream and self.cache.cacheable(url):
+            return self._cachedGET(url, params, timeout)
+        response = self.request('GET', url, params=params, stream=stream, timeout=timeout)
         if stream:
             ## todo nicer way
             return response
         return self.treatResponse(response)
 
+    def _cachedGET(self, url, params=None, timeout=None):
+        key = self.user + ' ' + self.server + self.appID + '/' + url
+        if params:
+            key += '?' + urlencode(sorted((k, v) for k, v in params.items() if v is not None))
+        entry = self.cache.get(key)
+        if entry is not None and entry.immutable:
+            return json.loads(entry.body)
+        headers = {}
+        if entry is not None:
+            if entry.etag:
+                headers['If-None-Match'] = entry.etag
+            if entry.lastModified:
+                headers['If-Modified-Since'] = entry.lastModified
+        response = self.request('GET', url, params=params, headers=headers, timeout=timeout)
+        if response.status_code == 304 and entry is not None:
+            logging.debug("HTTP status: \033[92m[304]\033[0m - " + response.url)
+            return json.loads(entry.body)
+        output = self.treatResponse(response)
+        etag = response.headers.get('ETag')
+        lastModified = response.headers.get('Last-Modified')
+        immutable = self.cache.immutable(url)
+        if response.status_code == 200 and response.text and (immutable or etag or lastModified):
+            self.cache.put(key, ResponseCacheEntry(etag, lastModified, response.text, immutable))
+        return output
+
     def POST(self, url, data, headers=None):
         h= {}
         if headers:
             h.update(headers)
-        response = self.session.post(self.server + self.appID + '/' + url
-            , headers=headers, data=data)
+        response = self.request('POST', url, headers=headers, data=data)
         return self.treatResponse(response)
 
     def DELETE(self, url):
-        return self.treatResponse(self.session.delete(self.server + self.appID+'/'+url))
+        return self.treatResponse(self.request('DELETE', url))
@@ -0,0 +1,199 @@
+"""
+Request metrics for OdkxConnection: latency histograms, bytes and status codes per endpoint
+set connection.metrics = RequestMetrics() to enable, any object with the same record and recordReceived methods can be used instead
+"""
+import re
+import bisect
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, List, Optional, Tuple
+
+# first matching template wins, urls are relative to the app root
+ENDPOINT_TEMPLATES = [
+    ('diff', re.compile(r'^tables/[^/]+/ref/[^/]+/diff')),
+    ('rows', re.compile(r'^tables/[^/]+/ref/[^/]+/rows')),
+    ('attachments', re.compile(r'^tables/[^/]+/ref/[^/]+/attachments/')),
+    ('definition', re.compile(r'^tables/[^/]+/ref/[^/]+$')),
+    ('properties', re.compile(r'^tables/[^/]+/properties/')),
+    ('acl', re.compile(r'^tables/[^/]+/acl')),
+    ('table', re.compile(r'^tables/[^/]+$')),
+    ('tables', re.compile(r'^tables/?$')),
+    ('manifest', re.compile(r'^manifest/')),
+    ('files', re.compile(r'^files/')),
+]
+
+# upper bounds in seconds, the last bucket is +Inf
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def endpointOf(url: str) -> str:
+    for name, pattern in ENDPOINT_TEMPLATES:
+        if pattern.match(url):
+            return name
+    return 'other'
+
+
+class _EndpointStats(object):
+    __slots__ = ('buckets', 'count', 'seconds', 'bytesSent', 'bytesReceived', 'statuses')
+
+    def __init__(self):
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.count = 0
+        self.seconds = 0.0
+        self.bytesSent = 0
+        self.bytesReceived = 0
+        self.statuses: Dict[str, int] = {}
+
+    def quantile(self, q: float) -> Optional[float]:
+        """
+        upper bound of the bucket holding the q quantile (None when it is in the +Inf bucket)
+        """
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(LATENCY_BUCKETS, self.buckets):
+            seen += n
+            if seen >= rank:
+                return bound
+        return None
+
+
+class ByteCounter(object):
+    """
+    bytes of the requests recorded inside a countBytes() block
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.sent = 0
+        self.received = 0
+
+    def add(self, sent: int, received: int):
+        with self._lock:
+            self.sent += sent
+            self.received += received
+
+
+# the counters of the enclosing countBytes() blocks. a context variable and not a global total, so a block only sees the requests
+# of its own thread (and of the threads that run in a copy of its context, see contextvars.copy_context)
+_byte_counters: ContextVar[Tuple[ByteCounter, ...]] = ContextVar('odkxpy_byte_counters', default=())
+
+
+@contextmanager
+def countBytes():
+    """
+    count the bytes of the requests recorded by RequestMetrics in this block
+    """
+    counter = ByteCounter()
+    token = _byte_counters.set(_byte_counters.get() + (counter,))
+    try:
+        yield counter
+    finally:
+        _byte_counters.reset(token)
+
+
+class RequestMetrics(object):
+    """
+    thread safe, one instance can be shared by several connections
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats: Dict[Tuple[str, str], _EndpointStats] = {}
+
+    def record(self, method: str, url: str, status: Optional[int], seconds: float, bytesSent: int, bytesReceived: int):
+        """
+        called by OdkxConnection after every request
+
+        :param url: relative to the app root
+        :param status: the http status, None when the request failed without a response
+        """
+        key = (endpointOf(url), method)
+        status_key = 'error' if status is None else str(status)
+        bucket = bisect.bisect_left(LATENCY_BUCKETS, seconds)
+        with self._lock:
+            s = self._stats.get(key)
+            if s is None:
+                s = self._stats[key] = _EndpointStats()
+            s.buckets[bucket] += 1
+            s.count += 1
+            s.seconds += seconds
+            s.bytesSent += bytesSent
+            s.bytesReceived += bytesReceived
+            s.statuses[status_key] = s.statuses.get(status_key, 0) + 1
+        for counter in _byte_counters.get():
+            counter.add(bytesSent, bytesReceived)
+
+    def recordReceived(self, method: str, url: str, bytesReceived: int):
+        """
+        called by OdkxConnection while a streamed response is read, the request itself was already recorded
+        """
+        key = (endpointOf(url), method)
+        with self._lock:
+            s = self._stats.get(key)
+            if s is None:
+                s = self._stats[key] = _EndpointStats()
+            s.bytesReceived += bytesReceived
+        for counter in _byte_counters.get():
+            counter.add(0, bytesReceived)
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+
+    def summary(self) -> Dict[str, dict]:
+        """
+        per "endpoint method": count, total and mean seconds, approximate p50/p95, bytes sent/received and the status codes
+        """
+        result = {}
+        with self._lock:
+            for (endpoint, method), s in sorted(self._stats.items()):
+                result[endpoint + ' ' + method] = {
+                    'count': s.count,
+                    'seconds': s.seconds,
+                    'mean': s.seconds / s.count,
+                    'p50': s.quantile(0.5),
+                    'p95': s.quantile(0.95),
+                    'bytesSent': s.bytesSent,
+                    'bytesReceived': s.bytesReceived,
+                    'statuses': dict(s.statuses),
+                }
+        return result
+
+    def bytesReceived(self) -> int:
+        with self._lock:
+            return sum(s.bytesReceived for s in self._stats.values())
+
+    def bytesSent(self) -> int:
+        with self._lock:
+            return sum(s.bytesSent for s in self._stats.values())
+
+    def prometheus(self, prefix: str = 'odkxpy_http') -> str:
+        """
+        the metrics in the prometheus text exposition format
+        """
+        lines: List[str] = []
+        with self._lock:
+            items = sorted(self._stats.items())
+            lines.append('# HELP {p}_request_duration_seconds duration of the requests to the sync endpoint'.format(p=prefix))
+            lines.append('# TYPE {p}_request_duration_seconds histogram'.format(p=prefix))
+            for (endpoint, method), s in items:
+                labels = 'endpoint="{e}",method="{m}"'.format(e=endpoint, m=method)
+                cumulative = 0
+                for bound, n in zip(LATENCY_BUCKETS + ('+Inf',), s.buckets):
+                    cumulative += n
+                    lines.append('{p}_request_duration_seconds_bucket{{{l},le="{b}"}} {n}'.format(p=prefix, l=labels, b=bound, n=cumulative))
+                lines.append('{p}_request_duration_seconds_sum{{{l}}} {v}'.format(p=prefix, l=labels, v=s.seconds))
+                lines.append('{p}_request_duration_seconds_count{{{l}}} {v}'.format(p=prefix, l=labels, v=s.count))
+            for name, attr, text in (('request_bytes_total', 'bytesSent', 'bytes sent'),
+                                     ('response_bytes_total', 'bytesReceived', 'bytes received')):
+                lines.append('# HELP {p}_{n} {t}'.format(p=prefix, n=name, t=text))
+                lines.append('# TYPE {p}_{n} counter'.format(p=prefix, n=name))
+                for (endpoint, method), s in items:
+                    lines.append('{p}_{n}{{endpoint="{e}",method="{m}"}} {v}'.format(
+                        p=prefix, n=name, e=endpoint, m=method, v=getattr(s, attr)))
+            lines.append('# HELP {p}_responses_total responses by status code'.format(p=prefix))
+            lines.append('# TYPE {p}_responses_total counter'.format(p=prefix))
+            for (endpoint, method), s in items:
+                for status, n in sorted(s.statuses.items()):
+                    lines.append('{p}_responses_total{{endpoint="{e}",method="{m}",status="{s}"}} {n}'.format(
+                        p=prefix, e=endpoint, m=method, s=status, n=n))
+        return '\n'.join(lines) + '\n'
@@ -1,27 +1,101 @@
 import sqlalchemy
-from .odkx_server_table import OdkxServerTable, OdkxServerTableRow, OdkxServerTableColumn, OdkxServerColumnDefinition, OdkxServerTableDefinition
+from .odkx_server_table import OdkxServerTable, OdkxServerTableRow, OdkxServerColumnDefinition, OdkxServerTableDefinition
 from .odkx_local_file import OdkxLocalFile
 from .odkx_manifest_cache import OdkTableManifestCache
-from sqlalchemy import MetaData, text
+from .odkx_bulk_loader import OdkxBulkLoader
+from .odkx_prefetch import RowsetPrefetcher
+from .odkx_attachment_sync import AttachmentSyncEngine, AttachmentSyncResult
+from .odkx_attachment_index import AttachmentHashIndex
+from .odkx_multipart import StreamingMultipartParser, partFilename
+from .odkx_row_converter import OdkxRowConverter
+from .odkx_pull_checkpoint import PullCheckpoint, PullCheckpointState
+from .odkx_sync_report import SyncReport
+from sqlalchemy import text
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 import os
-from typing import Optional, List
+import logging
+import threading
+from typing import Optional, List, Tuple
 import hashlib
 import requests
 import datetime
 import pandas as pd
+import numpy as np
 from enum import Enum
 from distutils.dir_util import copy_tree
-from requests_toolbelt.multipart import decoder as multi_decoder
 
 class LocalSyncMode(Enum):
     FULL = 1
     ONLY_NEW_RECORDS = 2
     ONLY_EXISTING_RECORDS = 3
 
+class PullMode(Enum):
+    FULL_LOG = 1
+    LATEST_ONLY = 2
+
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+
+def _bareMD5(md5hash: Optional[str]) -> Optional[str]:
+    """
+    the hex digest of a md5hash of the server, which is sent as "md5:<hex digest>"
+    """
+    return md5hash[4:] if md5hash and md5hash.startswith('md5:') else md5hash
+
+
+class AttachmentFileWriter(object):
+    """
+    writes one attachment to a temporary file while computing its md5. on close the file is moved into place,
+    unless the md5 does not match the expected one (then ok stays False and the existing file is kept)
+    """
+    def __init__(self, store: "FilesystemAttachmentStore", id: str, filename: str, expected_md5: Optional[str] = None):
+        self.store = store
+        self.id = id
+        self.filename = filename
+        self.expected_md5 = _bareMD5(expected_md5)
+        self.ok = False
+        self._closed = False
+        self._hash = hashlib.md5()
+        self._target = store.getFileName(id, filename)
+        self._file = open(self._target + '-tmp', 'wb')
+
+    def write(self, data: bytes):
+        self._hash.update(data)
+        self._file.write(data)
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._file.close()
+        md5 = self._hash.hexdigest()
+        if self.expected_md5 is not None and self.expected_md5 != md5:
+            os.remove(self._target + '-tmp')
+            return
+        if os.path.isfile(self._target):
+            os.remove(self._target)
+        os.rename(self._target + '-tmp', self._target)
+        self.ok = True
+        if self.store.hashIndex is not None:
+            st = os.stat(self._target)
+            self.store.hashIndex.put(self.id, self.filename, st.st_size, st.st_mtime_ns, md5)
+
+    def abort(self):
+        """
+        discard the temporary file if the writer was not closed yet
+        """
+        if self._closed:
+            return
+        self._closed = True
+        self._file.close()
+        os.remove(self._target + '-tmp')
+
+
 class FilesystemAttachmentStore(object):
-    def __init__(self, path, useWindowsPaths: bool = False):
+    def __init__(self, path, useWindowsPaths: bool = False, hashIndex: Optional[AttachmentHashIndex] = None):
         self.path = path
         self.useWindowsPaths = useWindowsPaths
+        self.hashIndex = hashIndex
 
     def okWindows(self, id):
         xid = id
@@ -40,42 +114,41 @@ class FilesystemAttachmentStore(object):
         return open(filename, 'rb')
 
     def getMD5(self, id, filename):
+        target = self.getFileName(id, filename)
+        if self.hashIndex is not None:
+            st = os.stat(target)
+            cached = self.hashIndex.get(id, filename, st.st_size, st.st_mtime_ns)
+            if cached is not None:
+                return cached
         hash_md5 = hashlib.md5()
-        with open(self.getFileName(id, filename), "rb") as f:
+        with open(target, "rb") as f:
             for chunk in iter(lambda: f.read(4096), b""):
                 hash_md5.update(chunk)
+        if self.hashIndex is not None:
+            self.hashIndex.put(id, filename, st.st_size, st.st_mtime_ns, hash_md5.hexdigest())
         return hash_md5.hexdigest()
 
+    def openFileWriter(self, id: str, filename: str, expected_md5: Optional[str] = None) -> "AttachmentFileWriter":
+        os.makedirs(os.path.join(self.path, self.okWindows(id)), exist_ok=True)
+        return AttachmentFileWriter(self, id, filename, expected_md5)
+
     def storeFile(self, id, filename, response: requests.Response):
-        target = self.getFileName(id, filename)
-        xid = id
-        if self.useWindowsPaths:
-            xid = id.replace(":","")
-        os.makedirs(os.path.join(self.path, xid),exist_ok=True)
-        with open(target + '-tmp', 'wb') as out_file:
-            for chunk in response.iter_content(1024):
-                out_file.write(chunk)
-        if os.path.isfile(target):
-            os.remove(target)
-        os.rename(target + '-tmp', target)
+        writer = self.openFileWriter(id, filename)
+        try:
+            for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                writer.write(chunk)
+            writer.close()
+        finally:
+            writer.abort()
         del response
 
     def storeFileData(self, id:str, filename:str, data:bytes):
-        def chunked(n):
-            for i in range(0, len(data), n):
-                yield data[i:i + n]
-
-        target = self.getFileName(id, filename)
-        xid = id
-        if self.useWindowsPaths:
-            xid = id.replace(":", "")
-        os.makedirs(os.path.join(self.path, xid), exist_ok=True)
-        with open(target + '-tmp', 'wb') as out_file:
-            for chunk in chunked(1024):
-                out_file.write(chunk)
-        if os.path.isfile(target):
-            os.remove(target)
-        os.rename(target + '-tmp', target)
+        writer = self.openFileWriter(id, filename)
+        try:
+            writer.write(data)
+            writer.close()
+        finally:
+            writer.abort()
         del data
 
     def getManifest(self, id) -> List[OdkxLocalFile]:
@@ -96,10 +169,17 @@ class OdkxLocalTable(object):
         self.tableId = tableId
         self._storage = storage
         self.schema = schema
-        self.attachments = FilesystemAttachmentStore(os.getcwd() if attachment_store_path is None else attachment_store_path, useWindowsPaths=storage.useWindowsCompatiblePaths)
+        hashIndex = AttachmentHashIndex(storage, tableId) if storage.cacheAttachmentHashes else None
+        self.attachments = FilesystemAttachmentStore(os.getcwd() if attachment_store_path is None else attachment_store_path,
+                                                     useWindowsPaths=storage.useWindowsCompatiblePaths, hashIndex=hashIndex)
         self.engine: sqlalchemy.engine.Engine = engine
+        self.pullCheckpoint = PullCheckpoint(storage, tableId)
         self.genericCols = ['id', 'rowETag', 'savepointTimestamp', 'dataETagAtModification', 'savepointCreator', 'formId', 'savepointType', 'lastUpdateUser']
         self.colAccess = ['defaultAccess',  'groupModify', 'groupPrivileged', 'groupReadOnly', 'rowOwner']
+        self._rowConverter: Optional[OdkxRowConverter] = None
+        # converter of row2rec and the column list it was built for
+        self._row2recConverter: Optional[Tuple[List[OdkxServerColumnDefinition], OdkxRowConverter]] = None
+        self.logBackfillThread: Optional[threading.Thread] = None
 
     def getTableDefinition(self) -> OdkxServerTableDefinition:
         return self._storage.getCachedTableDefinition(self.tableId)
@@ -121,26 +201,20 @@ class OdkxLocalTable(object):
         return str('')
 
     def _getStagingTable(self) -> sqlalchemy.Table:
-        meta = MetaData()
-        meta.reflect(self.engine, schema=self.schema, only=[self.tableId + '_staging'])
-        return meta.tables.get(self.schema+ '.' + self.tableId + '_staging')
+        return self._storage._getTableMeta(self.tableId + '_staging')
 
     def _getLogTable(self) -> sqlalchemy.Table:
-        meta = MetaData()
-        meta.reflect(self.engine, schema=self.schema, only=[self.tableId + '_log'])
-        return meta.tables.get(self.schema+ '.' + self.tableId + '_log')
+        return self._storage._getTableMeta(self.tableId + '_log')
 
     def _getDataTable(self) -> sqlalchemy.Table:
-        meta = MetaData()
-        meta.reflect(self.engine, schema=self.schema, only=[self.tableId])
-        return meta.tables.get(self.schema+ '.' + self.tableId)
+        return self._storage._getTableMeta(self.tableId)
 
     def _safeSql(self, sql, transaction: sqlalchemy.engine.Connection=None):
         if transaction is not None:
-            transaction.execute(sql)
+            return transaction.execute(sql)
         else:
             with self.engine.begin() as con:
-                con.execute(sql)
+                return con.execute(sql)
 
     def updateLocalStatusDb(self, dataETag, connection: sqlalchemy.engine.Connection=None):
         sql = f"""INSERT INTO {self.schema}.status_table ("table_name", "dataETag", "sync_date")
@@ -148,54 +222,127 @@ class OdkxLocalTable(object):
         self._safeSql(sql, connection)
 
 
+    def getRowConverter(self, definition: Optional[OdkxServerTableDefinition] = None) -> OdkxRowConverter:
+        """
+        the row converter for the given definition (default: the cached definition of this table). only the converter of the
+        cached definition is kept (until sync caches a definition with another schemaETag), it is reused for a definition with
+        the same schemaETag
+        """
+        if definition is None:
+            if self._rowConverter is None:
+                self._rowConverter = OdkxRowConverter(self.getTableDefinition())
+            return self._rowConverter
+        if self._rowConverter is not None and self._rowConverter.schemaETag == definition.schemaETag:
+            return self._rowConverter
+        return OdkxRowConverter(definition)
+
     def row_asdict(self, r: OdkxServerTableRow):
-        dct = {}
-        dct['rowETag'] = r.rowETag
-        dct['createUser'] = r.createUser
-        dct['lastUpdateUser'] = r.lastUpdateUser
-        dct['dataETagAtModification'] = r.dataETagAtModification
-        dct['savepointCreator'] = r.savepointCreator
-        dct['formId'] = r.formId
-        dct['locale'] = r.locale
-        dct['savepointType'] = r.savepointType
-        dct['savepointTimestamp'] = r.savepointTimestamp
-        dct['deleted'] = r.deleted
-        dct['defaultAccess'] = r.filterScope.defaultAccess
-        dct['groupModify'] = r.filterScope.groupModify
-        dct['groupPrivileged'] = r.filterScope.groupPrivileged
-        dct['groupReadOnly'] = r.filterScope.groupReadOnly
-        dct['rowOwner'] = r.filterScope.rowOwner
-        dct['id'] = r.id
-        for col in r.orderedColumns:
-            assert isinstance(col, OdkxServerTableColumn)
-            dct[col.column] =col.value
-        return dct
-
-
-    def stageAllDataChanges(self, remoteTable: OdkxServerTable) -> Optional[str]:
+        return self.getRowConverter().asdict(r)
+
+
+    def stageAllDataChanges(self, remoteTable: OdkxServerTable, bootstrap: bool = False, getFullLog: bool = True,
+                            report: Optional[SyncReport] = None) -> Optional[str]:
+        """
+        :param bootstrap: stage the current rows (rows endpoint) instead of the full change log since the local dataETag.
+            the returned dataETag is then the one of the first page, so changes made while paging are fetched by the next diff
+        :param getFullLog: stage every version of the changed rows, not only the latest one (of every page)
+        :return: the dataETag the staged data corresponds with
+
+        every page is committed together with a checkpoint (see PullCheckpoint). when the previous pull of the same changes
+        was interrupted, staging is kept and the pull continues after the last committed page, unless staging no longer
+        holds the rows of the checkpoint.
+        """
         st = self._getStagingTable()
-        last_rs = None
-        with self.engine.begin() as transaction:
-            transaction.execute(st.delete())
-            for rowset in remoteTable.getDiffGenerator(dataETag=self.getLocalDataETag(), getFullLog=True):
-                last_rs = rowset
-                if (len(rowset.rows) > 0):
-                    #transaction.execute(st.insert(), [self.row_asdict(x) for x in rowset.rows])
-                    transaction.execute(st.insert().values([self.row_asdict(x) for x in rowset.rows]))
-        if not last_rs is None:
-            return last_rs.dataETag
+        definition = self.getTableDefinition()
+        converter = self.getRowConverter(definition)
+        loader = OdkxBulkLoader(st, definition)
+        mode = 'rows' if bootstrap else ('diff_full' if getFullLog else 'diff')
+        start_etag = None if bootstrap else self.getLocalDataETag()
+        state = self.pullCheckpoint.get()
+        if state is not None and (state.mode, state.schemaETag, state.startDataETag) == (mode, definition.schemaETag, start_etag):
+            with self.engine.connect() as c:
+                staged = c.execute("""select count(*) from {schema}."{stagingtable}" """.format(schema=self.schema, stagingtable=st.name)).scalar()
+            if staged != state.stagedRows:
+                logging.warning("staging of %s lost rows since the last pull (%d instead of %d), restarting the pull",
+                                self.tableId, staged, state.stagedRows or 0)
+                state = None
+        else:
+            state = None
+        if state is not None:
+            logging.info("resuming pull of %s after %d pages", self.tableId, state.pages)
+        else:
+            state = PullCheckpointState(mode, definition.schemaETag, start_etag, None, None, None, 0, 0, False)
+            with self.engine.begin() as transaction:
+                transaction.execute("""TRUNCATE {schema}."{stagingtable}" """.format(schema=self.schema, stagingtable=st.name))
+                self.pullCheckpoint.clear(transaction)
+        if not state.complete:
+            # rows stay json dicts and are converted one by one while they are copied into staging
+            page_size = self._storage.pullPageSize
+            if bootstrap:
+                rowsets = remoteTable.getAllDataRowsGenerator(fetchLimit=page_size, cursor=state.cursor, raw=True)
+            else:
+                rowsets = remoteTable.getDiffGenerator(dataETag=start_etag, fetchLimit=page_size, getFullLog=getFullLog,
+                                                       cursor=state.cursor, raw=True)
+            if self._storage.pullPrefetchPages > 0:
+                rowsets = RowsetPrefetcher(rowsets, self._storage.pullPrefetchPages, self._storage.pullPrefetchMaxRows)
+            for rowset in rowsets:
+                with self.engine.begin() as transaction:
+                    if (len(rowset.rows) > 0):
+                        converter.checkRawColumns(rowset.rows[0], loader.columns)
+                        loader.loadValues(transaction, (converter.asvalues(x, loader.columns) for x in rowset.rows))
+                        if report is not None:
+                            report.addRows('staging', len(rowset.rows))
+                    state = state._replace(firstDataETag=state.firstDataETag or rowset.dataETag, lastDataETag=rowset.dataETag,
+                                           stagedRows=state.stagedRows + len(rowset.rows),
+                                           cursor=rowset.webSafeResumeCursor, pages=state.pages + 1, complete=not rowset.hasMoreResults)
+                    self.pullCheckpoint.save(transaction, state)
+                # release the rows before the next page is fetched
+                rowset.rows.clear()
+        if state.pages == 0:
+            return None
+        if bootstrap:
+            return state.firstDataETag
+        return state.lastDataETag
+
+    def backfillLog(self, remoteTable: OdkxServerTable):
+        """
+        download the full history of the table into [tableId]_log, skipping the versions that are already there.
+        this completes the log after a bootstrap pull, which only stores the latest version of every row
+        """
+        lt = self._getLogTable()
+        cols = [c.name for c in lt.columns]
+        converter = self.getRowConverter()
+        qry = pg_insert(lt).on_conflict_do_nothing()
+        for rowset in remoteTable.getDiffGenerator(dataETag=None, getFullLog=True):
+            if (len(rowset.rows) > 0):
+                records = [converter.asdict(x) for x in rowset.rows]
+                with self.engine.begin() as c:
+                    c.execute(qry, [{k: r.get(k) for k in cols} for r in records])
+
+    def startLogBackfill(self, remoteTable: OdkxServerTable) -> threading.Thread:
+        """
+        run backfillLog in a background thread (also available as logBackfillThread, join it to wait for completion)
+        """
+        def run():
+            try:
+                self.backfillLog(remoteTable)
+            except Exception:
+                logging.exception("backfilling %s_log failed", self.tableId)
+        self.logBackfillThread = threading.Thread(target=run, name="odkxpy-backfill-" + self.tableId)
+        self.logBackfillThread.start()
+        return self.logBackfillThread
 
     def isMissingFiles(self, rowId: str, target_file_list: List[str], manifest_files: List[str], other_manifest_files: List[str] = None):
         missing_files = [x for x in target_file_list if x not in manifest_files]
         if other_manifest_files:
             missing_files.extend([x for x in other_manifest_files if x not in manifest_files])
         if len(missing_files) > 0:
-            print("MISSING FILES (trying again on next sync) for ", rowId, str(missing_files), "\ngot\n", str(manifest_files))
+            logging.warning("MISSING FILES (trying again on next sync) for %s %s, got %s", rowId, missing_files, manifest_files)
             return True
 
     def attachmentsToDownload(self, remoteManifest: List[str], rowId: str):
         def filter_md5(f):
-            return not (self.attachments.hasFile(rowId, f.filename) and self.attachments.getMD5(rowId, f.filename) == f.md5hash) and f.contentLength
+            return not (self.attachments.hasFile(rowId, f.filename) and self.attachments.getMD5(rowId, f.filename) == _bareMD5(f.md5hash)) and f.contentLength
         to_fetch = list(filter(filter_md5, remoteManifest))
         return to_fetch
 
@@ -204,12 +351,10 @@ class OdkxLocalTable(object):
         for f in self.attachments.getManifest(rowId):
             remoteFileProperties = next((x for x in remoteManifest if x.filename == f.filename), None)
             if remoteFileProperties:
-                if remoteFileProperties.md5hash == f.md5hash:
+                if _bareMD5(remoteFileProperties.md5hash) == f.md5hash:
                     continue
-            print(rowId, f.filename)
-            with self.attachments.openLocalFile(rowId, f.filename) as datafile:
-                data = datafile.read()
-            to_push.append((f, data))
+            logging.debug("uploading attachment %s of %s", f.filename, rowId)
+            to_push.append((f, self.attachments.openLocalFile(rowId, f.filename)))
         return to_push
 
     def downloadAttachments(self, remoteTable: OdkxServerTable, rowId: str, target_file_list: List[str]):
@@ -217,15 +362,31 @@ class OdkxLocalTable(object):
         remote_manifest_files = [f.filename for f in remoteManifest]
         to_fetch = self.attachmentsToDownload(remoteManifest, rowId)
         if to_fetch:
-            store_attachments = remoteTable.getAttachments(rowId, to_fetch)
+            store_attachments = remoteTable.getAttachments(rowId, to_fetch, stream=True)
             if store_attachments.status_code != 200:
+                store_attachments.close()
                 if self.isMissingFiles(rowId, target_file_list, []):
                     return False
             else:
-                store_files = multi_decoder.MultipartDecoder.from_response(store_attachments)
-                for part in store_files.parts:
-                    self.attachments.storeFileData(rowId, str(part.headers[b'Content-Disposition']).split("=")[1][1:-2],
-                                                   part.content)
+                expected_md5 = {f.filename: f.md5hash for f in to_fetch}
+                writers = []
+
+                def on_part(headers):
+                    filename = partFilename(headers)
+                    writers.append(self.attachments.openFileWriter(rowId, filename, expected_md5.get(filename)))
+                    return writers[-1]
+
+                try:
+                    parser = StreamingMultipartParser(store_attachments.headers.get('Content-Type'), on_part)
+                    parser.parse(store_attachments.iter_content(DOWNLOAD_CHUNK_SIZE))
+                finally:
+                    store_attachments.close()
+                    for w in writers:
+                        w.abort()
+                corrupt = [w.filename for w in writers if not w.ok]
+                if corrupt:
+                    logging.warning("MD5 MISMATCH (trying again on next sync) for %s %s", rowId, corrupt)
+                    return False
                 local_manifest_files = [f.filename for f in self.attachments.getManifest(rowId)]
                 if self.isMissingFiles(rowId, target_file_list, remote_manifest_files, local_manifest_files):
                     return False
@@ -236,38 +397,49 @@ class OdkxLocalTable(object):
         local_manifest_files = [f.filename for f in self.attachments.getManifest(rowId)]
         to_push = self.attachmentsToUpload(remoteManifest, rowId)
         if to_push:
-            res = remoteTable.putAttachments(rowId, *zip(*to_push))
-            print(res)
+            try:
+                res = remoteTable.putAttachments(rowId, *zip(*to_push))
+            finally:
+                for _, datafile in to_push:
+                    datafile.close()
+            logging.debug("uploaded %d attachments of %s: %s", len(to_push), rowId, res)
 
         remote_manifest_files = [f.filename for f in remoteManifest]
         if self.isMissingFiles(rowId, target_file_list, local_manifest_files, remote_manifest_files):
             return False
         return True
 
-    def _writeSuccess(self, table, id, state_col):
-        with self.engine.connect() as c:
-            c.execute(sqlalchemy.sql.text(f"""update {self.schema}."{table}" set {state_col}='synced' where id=:rowid"""), rowid=id)
+    def _writeSuccessBatch(self, table, ids: List[str], state_col):
+        qry = sqlalchemy.sql.text(f"""update {self.schema}."{table}" set {state_col}='synced' where id in :rowids""")
+        qry = qry.bindparams(sqlalchemy.bindparam('rowids', expanding=True))
+        with self.engine.begin() as c:
+            c.execute(qry, rowids=ids)
 
-    def _sync_attachments(self, remoteTable: OdkxServerTable, state_col:str = "state", localTable: str = None):
+    def _sync_attachments(self, remoteTable: OdkxServerTable, state_col:str = "state", localTable: str = None,
+                          report: Optional[SyncReport] = None):
         """ Sync the attachments for the rowids in state "sync_attachments"
         """
+        if report is None:
+            report = SyncReport(self.tableId)
+        with report.phase('attachments'):
+            result = self._sync_attachments_rows(remoteTable, state_col, localTable)
+        report.addRows('attachments', len(result.synced))
+        if result.failed:
+            logging.warning("%d rows of %s still have missing attachments (trying again on next sync)", len(result.failed), self.tableId)
+        return result
+
+    def _sync_attachments_rows(self, remoteTable: OdkxServerTable, state_col:str = "state", localTable: str = None):
         attach_cols = [x.elementKey for x in self.getTableDefinition().columns if x.elementType == 'rowpath']
         if localTable:
             mode = "pushing"
-            with self.engine.begin() as c:
-                res = c.execute("""SELECT column_name FROM information_schema.columns
-                             WHERE table_schema = '{schema}' AND table_name = '{table}'
-                             AND column_name LIKE '%%_uriFragment';
-                          """.format(schema=self.schema, table=localTable))
-                resColumns = res.fetchall()
-            attach_cols = [col[0] for col in resColumns]
+            attach_cols = self._uriFragmentColumns(localTable)
             table = localTable
         else:
             mode = "pulling"
             table = self.tableId
 
         if len(attach_cols) == 0:
-            return
+            return AttachmentSyncResult([], [])
         ids = []
         files_by_id = {}
         with self.engine.connect() as c:
@@ -278,15 +450,11 @@ class OdkxLocalTable(object):
             for r in result:
                 ids.append(r['id'])
                 files_by_id[r['id']] = [r[x] for x in attach_cols if not r[x] is None]
-        print(mode + " ", len(ids), " rows attachments")
+        logging.info("%s attachments of %d rows of %s", mode, len(ids), self.tableId)
 
-        for id in ids:
-            if mode == "pushing":
-                if self.uploadAttachments(remoteTable, id, files_by_id[id]):
-                    self._writeSuccess(table, id, state_col)
-            elif mode == "pulling":
-                if self.downloadAttachments(remoteTable, id, files_by_id[id]):
-                    self._writeSuccess(table, id, state_col)
+        engine = AttachmentSyncEngine(self, remoteTable, table, state_col, workers=self._storage.attachmentWorkers,
+                                      host_concurrency=self._storage.attachmentHostConcurrency)
+        return engine.run(mode, ids, files_by_id)
 
     def _staging_to_log(self, connection: sqlalchemy.engine.Connection = None, stagingtable = None):
         if stagingtable is not None:
@@ -302,6 +470,8 @@ class OdkxLocalTable(object):
         from {schema}."{stagingtable}" stage left outer join {schema}."{logtable}" log
         on stage."rowETag" = log."rowETag"
         where log."rowETag" is null
+        -- backfillLog can insert the same versions concurrently, the join alone does not see its uncommitted rows
+        ON CONFLICT DO NOTHING
         """.format(
                 schema= self.schema,
                 logtable=self.tableId+'_log',
@@ -309,33 +479,58 @@ class OdkxLocalTable(object):
                 stagingtable=self.tableId+'_staging',
                 prefixed_fields=prefixed_fields
             )
-        self._safeSql(sql, connection)
+        return self._safeSql(sql, connection)
 
 
-    def hasIncomingChanges(self, remoteTable: OdkxServerTable) -> bool:
+    def hasIncomingChanges(self, remoteTable: OdkxServerTable, remote_dataETag: Optional[str] = None) -> bool:
         """
         :param remoteTable:
+        :param remote_dataETag: the dataETag of the table on the server when it is already known (eg from OdkxServerMeta.getTablesInfo)
         :return: true if there are changes on the server that have not been downloaded yet. use the "sync" function to download these changes
         """
-        return remoteTable.getdataETag() != self.getLocalDataETag()
-
-    def _sync_iter_pull(self, remoteTable: OdkxServerTable, no_attachments: bool = False):
-        if remoteTable.getdataETag() == self.getLocalDataETag():
+        if remote_dataETag is None:
+            remote_dataETag = remoteTable.getdataETag()
+        return remote_dataETag != self.getLocalDataETag()
+
+    def _sync_iter_pull(self, remoteTable: OdkxServerTable, no_attachments: bool = False, bootstrap: bool = False,
+                        pull_mode: PullMode = PullMode.FULL_LOG, remote_dataETag: Optional[str] = None,
+                        report: Optional[SyncReport] = None):
+        if report is None:
+            report = SyncReport(self.tableId)
+        local_etag = self.getLocalDataETag()
+        if remote_dataETag is None:
+            remote_dataETag = remoteTable.getdataETag()
+        if remote_dataETag == local_etag:
             ## we still need to check if we need to download attachments
-            self._sync_attachments(remoteTable)
+            self._sync_attachments(remoteTable, report=report)
             return False
-        new_etag = self.stageAllDataChanges(remoteTable)
+        full_log = pull_mode == PullMode.FULL_LOG
+        # only a table that was never synced can be bootstrapped
+        with report.phase('staging'):
+            new_etag = self.stageAllDataChanges(remoteTable, bootstrap=bootstrap and local_etag in ('', None), getFullLog=full_log,
+                                                report=report)
         st = self._getStagingTable()
         colnames = [x.name for x in st.columns]
         with self.engine.begin() as trans:
-            # delete rows to be updated
-            trans.execute("""delete from {schema}."{table}" where id in (select id from {schema}."{stagingtable}")""".format(
-                schema=self.schema, table=self.tableId, stagingtable=self.tableId + '_staging'
-            ))
             fields = ','.join(['"{colname}"'.format(colname=colname) for colname in colnames])
             fields_v = ','.join(['st."{colname}"'.format(colname=colname) for colname in colnames])
-            # insert new and updated rows
-            insert_sql = """
+            # new rows are inserted, existing rows are only rewritten when their rowETag changed
+            upsert = """
+            ON CONFLICT (id) DO UPDATE SET {updates}, state = EXCLUDED.state
+            WHERE {schema}."{table}"."rowETag" IS DISTINCT FROM EXCLUDED."rowETag"
+            """.format(
+                schema=self.schema, table=self.tableId,
+                updates=','.join(['"{c}" = EXCLUDED."{c}"'.format(c=c) for c in colnames if c != 'id']))
+            if not full_log:
+                # staging holds (nearly) one version per row, the same id can only come back in a later page
+                insert_sql = """
+                insert into {schema}."{table}" ({fields},state)
+                select DISTINCT ON (st.id) {fields_v}, 'sync_attachments' as state
+                from {schema}."{stagingtable}" st
+                ORDER BY st.id, st."savepointTimestamp" DESC, st."rowETag" DESC
+                """
+            else:
+                insert_sql = """
             WITH latest AS (
                 SELECT p."rowETag",
                        ROW_NUMBER() OVER(PARTITION BY p.id
@@ -346,14 +541,19 @@ class OdkxLocalTable(object):
             (select latest."rowETag" from latest
             WHERE latest.rk = 1) f
             ON f."rowETag" = st."rowETag"
-            """.format(
-                schema=self.schema, table=self.tableId, stagingtable=self.tableId+'_staging', fields=fields, fields_v=fields_v)
+            """
+            insert_sql = insert_sql.format(
+                schema=self.schema, table=self.tableId, stagingtable=self.tableId+'_staging', fields=fields, fields_v=fields_v) + upsert
             #print(insert_sql)
-            trans.execute(insert_sql)
-            self._staging_to_log(trans, stagingtable=st)
+            with report.phase('merge'):
+                report.addRows('merge', trans.execute(insert_sql).rowcount)
+            if full_log:
+                with report.phase('log'):
+                    report.addRows('log', self._staging_to_log(trans, stagingtable=st).rowcount)
             self.updateLocalStatusDb(new_etag, trans)
+            self.pullCheckpoint.clear(trans)
         if not no_attachments:
-            self._sync_attachments(remoteTable)
+            self._sync_attachments(remoteTable, report=report)
         return True
 
 
@@ -409,131 +609,107 @@ class OdkxLocalTable(object):
         return qry
 
 
+    def _writePushOutcomes(self, localTable: str, state_col: str, id_list_good: List[str], id_list_conflict: List[str],
+                           fullHistory: bool, id_and_rowETag_list: List[List[str]]):
+        """
+        store the outcome of one pushed batch in a single transaction
+        """
+        with self.engine.begin() as c:
+            for ids, state in ((id_list_good, 'sync_attachments'), (id_list_conflict, 'conflict')):
+                if not ids:
+                    continue
+                qry = """update {schema}."{localtable}" set {state_col}=:state where id in :ids""".format(
+                    schema=self.schema,
+                    localtable=localTable,
+                    state_col=state_col
+                )
+                if fullHistory:
+                    qry = qry + f""" and {state_col} LIKE 'historyUpload' """
+                c.execute(text(qry).bindparams(sqlalchemy.bindparam('ids', expanding=True)), state=state, ids=ids)
+            if fullHistory and id_and_rowETag_list:
+                rev_table = localTable + "_rev"
+                c.execute(text("""delete from {schema}."{table}" where id in :ids""".format(schema=self.schema, table=rev_table))
+                          .bindparams(sqlalchemy.bindparam('ids', expanding=True)), ids=[x[0] for x in id_and_rowETag_list])
+                c.execute(text("""insert into {schema}."{table}" (id, "rowETag") values (:id, :rowETag)""".format(schema=self.schema, table=rev_table)),
+                          [{'id': x[0], 'rowETag': x[1]} for x in id_and_rowETag_list])
+
     def _sync_iter_push(self, remoteTable: OdkxServerTable, localTable: str, mapping: dict = None,
-                        fullHistory: bool = False, force_push: bool = False, no_attachments: bool = False):
-        definition = remoteTable.getTableDefinition().columns
-        id_list_good = []
-        id_list_conflict = []
+                        fullHistory: bool = False, force_push: bool = False, no_attachments: bool = False, batch_size: Optional[int] = None,
+                        report: Optional[SyncReport] = None):
+        """
+        push the new and modified rows of localTable in batches of batch_size rows (default: SqlLocalStorage.pushBatchSize).
+        the outcome of every batch is committed before the next batch is sent, so an interrupted push continues where it stopped.
+
+        :return: the dataETag of the server table after the last batch, None when nothing was pushed
+        """
+        tableDefinition = remoteTable.getTableDefinition()
+        definition = tableDefinition.columns
+        converter = self.getRowConverter(tableDefinition)
+        if batch_size is None:
+            batch_size = self._storage.pushBatchSize
         if not fullHistory:
             state_col = "state"
         else:
             state_col = "state_upload"
-            id_and_rowETag_list = []
 
-        if (self.hasUnresolvedConflicts(localTable, state_col)):
-            raise Exception("unresolved conflicts, cannot push changes")
+        if report is None:
+            report = SyncReport(self.tableId)
+        with report.phase('conflicts'):
+            if (self.hasUnresolvedConflicts(localTable, state_col)):
+                raise Exception("unresolved conflicts, cannot push changes")
 
-        records = []
         if not fullHistory:
             state_qry = self._qryState(localTable, tableDefinition=definition, state=['new', 'modified'], force_push=force_push)
-            with self.engine.connect() as c:
-                for row in c.execute(state_qry):
-                    records.append(self.row2rec(row, definition, remoteTable.connection.user))
-                    dataETag = self.getLocalDataETag()
+            dataETag = self.getLocalDataETag()
         else:
             state_qry = self._getHistoryBatch(localTable, state=['historyUpload'], mapping=mapping)
-            with self.engine.connect() as c:
-                for row in c.execute(state_qry):
-                    records.append(self.row2rec(row, definition, remoteTable.connection.user, full=False))
-                    dataETag = remoteTable.getdataETag()
-
-        if (len(records) == 0):
-            return None
-        json = {'rows': records, 'dataETag': dataETag}
+            dataETag = remoteTable.getdataETag()
+        # rows leave the selected states once their outcome is written, so this always returns the next batch
+        state_qry = state_qry + " LIMIT {n}".format(n=int(batch_size))
+        pushed_dataETag = None
+
+        while True:
+            with report.phase('push'):
+                with self.engine.connect() as c:
+                    records = [converter.asrecord(row, remoteTable.connection.user, full=not fullHistory) for row in c.execute(state_qry)]
+                if (len(records) == 0):
+                    break
+                json = {'rows': records, 'dataETag': dataETag}
+                del records
+
+                rs = remoteTable.alterDataRows(json)
+                dataETag = rs.get('dataETag') or dataETag
+                pushed_dataETag = rs.get('dataETag')
+
+                id_list_good = []
+                id_list_conflict = []
+                id_and_rowETag_list = []
+                for outcome in rs['rows']:
+                    if outcome['outcome'] == 'IN_CONFLICT':
+                        id_list_conflict.append(outcome['id'])
+                        if fullHistory:
+                           raise Exception("During this process. No one should update the server")
+                    else:
+                        id_list_good.append(outcome['id'])
+                        if fullHistory:
+                            id_and_rowETag_list.append([outcome['id'], outcome['rowETag']])
+                if not id_list_good and not id_list_conflict:
+                    raise Exception("server returned no outcomes for the pushed rows, stopping to avoid pushing them again")
+                logging.info("pushed %d rows of %s (%d conflicts)", len(json['rows']), self.tableId, len(id_list_conflict))
+                report.addRows('push', len(id_list_good))
+                report.addRows('conflicts', len(id_list_conflict))
+                self._writePushOutcomes(localTable, state_col, id_list_good, id_list_conflict, fullHistory, id_and_rowETag_list)
 
-        rs = remoteTable.alterDataRows(json)
-
-        for outcome in rs['rows']:
-            if outcome['outcome'] == 'IN_CONFLICT':
-                id_list_conflict.append(outcome['id'])
-                if fullHistory:
-                   raise Exception("During this process. No one should update the server")
-            else:
-                id_list_good.append(outcome['id'])
-                if fullHistory:
-                    id_and_rowETag_list.append([outcome['id'], outcome['rowETag']])
-
-        def chunks(l, n):
-            """Yield successive n-sized chunks from l."""
-            for i in range(0, len(l), n):
-                yield l[i:i + n]
-
-        for chunk in chunks(id_list_good, 10):
-            qry = """update {schema}."{localtable}" set {state_col}='sync_attachments' where id in ({ids})""".format(
-                schema=self.schema,
-                localtable=localTable,
-                state_col=state_col,
-                ids=','.join(["'{c}'".format(c=c) for c in chunk])
-            )
-            if fullHistory:
-                qry = qry + f""" and {state_col} LIKE 'historyUpload' """
-            with self.engine.begin() as c:
-                c.execute(qry)
-        for chunk in chunks(id_list_conflict, 10):
-            qry = """update {schema}."{localtable}" set {state_col}='conflict' where id in ({ids})""".format(
-                schema=self.schema,
-                localtable=localTable,
-                state_col=state_col,
-                ids=','.join(["'{c}'".format(c=c) for c in chunk])
-            )
-            if fullHistory:
-                qry = qry + f""" and {state_col} LIKE 'historyUpload' """
-            with self.engine.begin() as c:
-                print(qry)
-                c.execute(qry)
-        if fullHistory:
-            df = pd.DataFrame(id_and_rowETag_list, columns=["id", "rowETag"])
-            ids = df['id'].tolist()
-            with self.engine.begin() as trans:
-                trans.execute("""delete from {schema}."{table}" where id in ({ids})""".format(
-                    schema=self.schema,
-                    table=localTable+"_rev",
-                    ids=','.join([f"'{id_}'" for id_ in ids])
-                ))
-            df.to_sql(localTable+"_rev", self.engine, schema=self.schema, if_exists='append', index=False)
         if not no_attachments and not fullHistory:
-            self._sync_attachments(remoteTable, state_col, localTable)
+            self._sync_attachments(remoteTable, state_col, localTable, report=report)
+        return pushed_dataETag
 
     def row2rec(self,row: dict, definition: List[OdkxServerColumnDefinition], default_user: str, full: bool = True):
-        datacols = [x.elementKey for x in definition if x.isMaterialized()]
-        ## TODO refactor
-        if full:
-           for c in datacols:
-               if not c in row.keys():
-                   raise Exception("schema's have diverged: on ODKX server i got column {c} but i couldn't find it locally. please fix.".format(c=c))
-        tupColAccess = ('defaultAccess',  'groupModify', 'groupPrivileged', 'groupReadOnly', 'rowOwner')
-        tupColnames = tuple(datacols)
-        filterScope = {}
-        orderedColumns = []
-        for c in tupColAccess:
-            if (c == 'defaultAccess' and row[c] is None):
-                filterScope[c] = 'FULL'
-            else:
-                filterScope[c] = row[c]
-        for c in tupColnames:
-            if full:
-                orderedColumns.append({'column':c,'value':row[c]})
-            else:
-                if c in row.keys():
-                    orderedColumns.append({'column':c,'value':row[c]})
-
-        result = {}
-        result['filterScope'] = filterScope
-        result['orderedColumns'] = orderedColumns
-        fix_row_fields = ['createUser', 'lastUpdateUser', 'dataETagAtModification', 'rowETag', 'savepointCreator',
-                          'formId', 'locale', 'savepointType', 'savepointTimestamp', 'deleted', 'id']
-        for k in [ x for x in row.keys() if x in fix_row_fields]:
-            if (k == 'savepointTimestamp' and row[k] is None):
-                result[k] = str(datetime.datetime.now())
-            elif (k == 'savepointTimestamp' and isinstance(row[k], datetime.datetime)):
-                result[k] = str(row[k])
-            elif (k == 'savepointType' and row[k] is None):
-                result[k] = 'COMPLETE'
-            elif (k in ('createUser','lastUpdateUser', 'savepointCreator') and row[k] is None):
-                result[k] = default_user
-            else:
-                result[k] = row[k]
-        return result
+        # callers pass the same column list for every row, so the converter is only rebuilt when it is another list
+        if self._row2recConverter is None or self._row2recConverter[0] is not definition:
+            converter = OdkxRowConverter(OdkxServerTableDefinition(None, self.tableId, definition))
+            self._row2recConverter = (definition, converter)
+        return self._row2recConverter[1].asrecord(row, default_user, full)
 
     def _cache_manifest(self, remoteTable: OdkxServerTable):
         session = self._storage.Session()
@@ -541,29 +717,51 @@ class OdkxLocalTable(object):
             self.tableId, remoteTable.getFileManifest()
         )
 
-    def sync(self, remoteTable: OdkxServerTable, local_changes_prefix: Optional[str] = None, force_push: bool = False, no_attachments: bool = False):
+    def sync(self, remoteTable: OdkxServerTable, local_changes_prefix: Optional[str] = None, force_push: bool = False, no_attachments: bool = False,
+             bootstrap: bool = False, backfill_log: bool = False, pull_mode: PullMode = PullMode.FULL_LOG,
+             remote_dataETag: Optional[str] = None, profile: bool = False, trace_memory: bool = False) -> SyncReport:
         """
 
         :param remoteTable: the OdkxServerTable you want to sync with
         :param local_changes_prefix: the prefix of the local changes to push (when left empty , it will not push, only pull)
         :param force_push: if the server has more recent changes than our local changes, push anyway, overwriting the changes on the server
         :param no_attachments: ignore the attachments for now (the rows will remain in sync_attachments state, so they will be synced next time when you don't pass no_attachments)
-        :return:
+        :param bootstrap: when the local table was never synced, fill it from the current rows instead of downloading the full history.
+            the _log table then only contains the latest version of every row
+        :param backfill_log: after a bootstrap, download the full history into the _log table in a background thread (see startLogBackfill)
+        :param pull_mode: FULL_LOG keeps every version of every row in the _log table. LATEST_ONLY only downloads the latest version
+            of the changed rows and does not maintain the _log table
+        :param remote_dataETag: the dataETag of the table on the server when it is already known (eg from OdkxServerMeta.getTablesInfo),
+            saves a request
+        :param profile: profile every phase with cProfile (see SyncReport)
+        :param trace_memory: record the peak memory of every phase with tracemalloc (see SyncReport)
+        :return: the time, rows and bytes of every phase
         """
-        self._cache_manifest(remoteTable)
-        session = self._storage.Session()
-        self._storage._cache_table_defintion(remoteTable.getTableDefinition(), session)
-        self._sync_iter_pull(remoteTable, no_attachments)
+        report = SyncReport(self.tableId, metrics=getattr(remoteTable.connection, 'metrics', None), profile=profile, trace_memory=trace_memory)
+        with report.phase('manifest'):
+            self._cache_manifest(remoteTable)
+        with report.phase('definition'):
+            session = self._storage.Session()
+            definition = remoteTable.getTableDefinition()
+            self._storage._cache_table_defintion(definition, session)
+            if self._rowConverter is not None and self._rowConverter.schemaETag != definition.schemaETag:
+                self._rowConverter = None
+        bootstrapping = bootstrap and self.getLocalDataETag() in ('', None)
+        self._sync_iter_pull(remoteTable, no_attachments, bootstrap=bootstrapping, pull_mode=pull_mode, remote_dataETag=remote_dataETag,
+                             report=report)
+        if bootstrapping and backfill_log and pull_mode == PullMode.FULL_LOG:
+            self.startLogBackfill(remoteTable)
         if local_changes_prefix is not None:
             localTable = self.tableId + '_' + local_changes_prefix
-            self._sync_iter_push(remoteTable, localTable, force_push=force_push, no_attachments=no_attachments)
-            rs = self._sync_iter_pull(remoteTable, no_attachments=no_attachments)
-            return rs
+            pushed_dataETag = self._sync_iter_push(remoteTable, localTable, force_push=force_push, no_attachments=no_attachments,
+                                                   report=report)
+            self._sync_iter_pull(remoteTable, no_attachments=no_attachments, pull_mode=pull_mode, remote_dataETag=pushed_dataETag,
+                                 report=report)
+        logging.info("%s", report)
+        return report
 
     def _getTableMeta(self, tablename: str) -> sqlalchemy.Table:
-        meta = sqlalchemy.MetaData()
-        meta.reflect(self.engine, schema=self.schema, only=[tablename])
-        return meta.tables.get(self.schema+ '.' + tablename)
+        return self._storage._getTableMeta(tablename)
 
 
     def _getHashedColumns(self, table_name):
@@ -575,12 +773,51 @@ class OdkxLocalTable(object):
                            if not x.name in exclude_columns]
         return columns_to_hash
 
-    def fillHashColumn(self, table_name):
+    def _ensureHashTrigger(self, table_name: str, columns_to_hash: List[str]) -> bool:
+        """
+        install a trigger that keeps the hash column up to date on insert and update.
+        the hashed columns are stored as comment on the trigger function, so it is only replaced when they change
+
+        :return: true if the trigger was (re)installed, meaning the existing hashes can be stale
+        """
+        signature = ','.join(columns_to_hash)
+        fname = hashlib.md5((table_name + '_odkxpy_hash').encode('utf-8')).hexdigest()[:16]
+        fname = 'odkxpy_hash_' + fname
+        with self.engine.begin() as c:
+            current = c.execute(text("""select obj_description(p.oid, 'pg_proc') from pg_proc p
+                join pg_namespace n on n.oid = p.pronamespace where n.nspname = :schema and p.proname = :fname"""),
+                                schema=self.schema, fname=fname).scalar()
+            if current == signature:
+                return False
+            c.execute("""CREATE OR REPLACE FUNCTION {schema}."{fname}"() RETURNS trigger AS $$
+                BEGIN
+                    NEW.hash := md5(ROW({cols})::TEXT);
+                    RETURN NEW;
+                END
+                $$ LANGUAGE plpgsql""".format(schema=self.schema, fname=fname,
+                                              cols=','.join(['NEW."{c}"'.format(c=c) for c in columns_to_hash])))
+            c.execute("""DROP TRIGGER IF EXISTS "{fname}" ON {schema}."{table}" """.format(schema=self.schema, fname=fname, table=table_name))
+            c.execute("""CREATE TRIGGER "{fname}" BEFORE INSERT OR UPDATE ON {schema}."{table}"
+                FOR EACH ROW EXECUTE PROCEDURE {schema}."{fname}"()""".format(schema=self.schema, fname=fname, table=table_name))
+            c.execute("""COMMENT ON FUNCTION {schema}."{fname}"() IS '{signature}'""".format(
+                schema=self.schema, fname=fname, signature=signature.replace("'", "''")))
+        return True
+
+    def fillHashColumn(self, table_name, incremental: bool = True):
+        """
+        compute the hash column of a table. with SqlLocalStorage(incrementalHashing=True) a trigger maintains the hashes,
+        and only rows without a hash (from before the trigger existed) are updated here
+
+        :param incremental: False for tables that are reloaded and updated in bulk (staging): they are always hashed with
+            a single UPDATE, a trigger would hash every row again on each of those updates
+        """
         columns_to_hash = self._getHashedColumns(table_name)
         qry = """UPDATE {schema}."{table}" set hash=md5(ROW({cols})::TEXT)""".format(
             schema=self.schema,
             table=table_name,
             cols=','.join(['"{c}"'.format(c=c) for c in columns_to_hash]))
+        if self._storage.incrementalHashing and incremental and not self._ensureHashTrigger(table_name, columns_to_hash):
+            qry = qry + " WHERE hash IS NULL"
         with self.engine.begin() as c:
             c.execute(qry)
 
@@ -624,7 +861,38 @@ class OdkxLocalTable(object):
             with self.engine.begin() as c:
                 c.execute(qry)
 
-    def localSyncFromDataframe(self, source_prefix: str, external_id_column: str, df: pd.DataFrame, localSyncMode: LocalSyncMode = LocalSyncMode.FULL):
+    def _changedDataframeRows(self, source_prefix: str, external_id_column: str, df: pd.DataFrame, localSyncMode: LocalSyncMode) -> pd.DataFrame:
+        """
+        the rows of df that are new or differ from [tableId]_[source_prefix] in one of the columns of df, compared in memory.
+        other columns are not compared: rows that only differ there are left alone.
+        """
+        def_tn = self.tableId + '_' + source_prefix
+        self._copyMissingData(self.tableId, def_tn)
+        def_cols = [x.name for x in self._getTableMeta(def_tn).columns]
+        cols = [c for c in list(df) if c != external_id_column and c in def_cols and c not in ('hash', 'state')]
+        qry = """SELECT {cols} FROM {schema}."{tn}" """.format(
+            schema=self.schema, tn=def_tn, cols=','.join(['"{c}"'.format(c=c) for c in [external_id_column] + cols]))
+        with self.engine.connect() as c:
+            current = pd.read_sql(qry, c)
+        current = current.drop_duplicates(subset=[external_id_column], keep='last').set_index(external_id_column)
+
+        is_new = (~df[external_id_column].isin(current.index)).to_numpy()
+        left = df[cols].to_numpy(dtype=object)[~is_new]
+        right = current.reindex(df[external_id_column][~is_new])[cols].to_numpy(dtype=object)
+        same = (left == right) | (pd.isna(left) & pd.isna(right))
+        is_changed = np.zeros(len(df), dtype=bool)
+        is_changed[~is_new] = ~same.all(axis=1)
+
+        if localSyncMode == LocalSyncMode.ONLY_NEW_RECORDS:
+            keep = is_new
+        elif localSyncMode == LocalSyncMode.ONLY_EXISTING_RECORDS:
+            keep = is_changed
+        else:
+            keep = is_new | is_changed
+        return df[keep]
+
+    def localSyncFromDataframe(self, source_prefix: str, external_id_column: str, df: pd.DataFrame, localSyncMode: LocalSyncMode = LocalSyncMode.FULL,
+                               diffInMemory: bool = False):
         """
         to sync changes from a dataframe:
           * first do initializeExternalSource
@@ -642,23 +910,38 @@ class OdkxLocalTable(object):
         :param external_id_column: the "ID" you want to use as primary key for this operation. if you just want to use the ODKX id, pas "id"
         :param df: a dataframe containing at least the external_id_column and then one or more columns that also appear in the ODKX table.
         :param localSyncMode: FULL or ONLY_NEW_RECORDS. when ONLY_NEW_RECORDS then modifications will not be synced only additions.
+        :param diffInMemory: compare df with the current [tableId]_[source_prefix] rows in pandas first, and only write the new and
+            changed rows to the staging table. the cost then scales with the number of changes instead of the size of df
         :return:
         """
         staging_tn = self.tableId + '_' + source_prefix + '_staging'
         hash_cols = self._getHashedColumns(staging_tn)
         missing_cols = [x for x in hash_cols if not x in list(df)]
-        qry = """DELETE FROM {schema}."{tn}" """.format(schema=self.schema, tn=staging_tn)
+        if diffInMemory:
+            df = self._changedDataframeRows(source_prefix, external_id_column, df, localSyncMode)
+        qry = """TRUNCATE {schema}."{tn}" """.format(schema=self.schema, tn=staging_tn)
         with self.engine.begin() as c:
             c.execute(qry)
         df.to_sql(staging_tn, schema=self.schema, if_exists='append', index=False, con=self.engine)
         self.resetColumns(staging_tn, missing_cols, external_id_column)
         self.localSyncFromStagingTable(source_prefix, external_id_column, localSyncMode)
 
+    def _uriFragmentColumns(self, table: str) -> List[str]:
+        """
+        the attachment columns of a table with local changes (external source or history table)
+        """
+        return [c['name'] for c in sqlalchemy.inspect(self.engine).get_columns(table, schema=self.schema)
+                if c['name'].endswith('uriFragment')]
+
     def hasPendingLocalChanges(self, source_prefix: str):
         def_tn = self.tableId + '_' + source_prefix
+        done_states = ['unchanged', 'synced']
+        if not self._uriFragmentColumns(def_tn):
+            # without attachment columns, pushed rows stay in sync_attachments state (like in hasPendingAttachments)
+            done_states.append('sync_attachments')
         q_test = """
-        select count(id) as aantal from {schema}."{deftn}" where not state in ('unchanged', 'synced')
-        """.format(schema=self.schema, deftn=def_tn)
+        select count(id) as aantal from {schema}."{deftn}" where not state in ({states})
+        """.format(schema=self.schema, deftn=def_tn, states=','.join("'" + x + "'" for x in done_states))
         with self.engine.connect() as c:
             res = c.execute(q_test)
             for r in res:
@@ -666,6 +949,19 @@ class OdkxLocalTable(object):
                     return True
         return False
 
+    def hasPendingAttachments(self, def_tn: Optional[str] = None, state_col: str = "state"):
+        """
+        rows of the table that still wait for their attachments. always False for the data table of a table
+        without attachment columns, its rows stay in sync_attachments state
+        """
+        if def_tn is None and not any(x.elementType == 'rowpath' for x in self.getTableDefinition().columns):
+            return False
+        q_test = """
+        select 1 from {schema}."{deftn}" where {state_col} = 'sync_attachments' limit 1
+        """.format(schema=self.schema, deftn=def_tn or self.tableId, state_col=state_col)
+        with self.engine.connect() as c:
+            return c.execute(q_test).first() is not None
+
     def hasUnresolvedConflicts(self, def_tn: str, state_col:str):
         q_test = """
         select count(id) as aantal from {schema}."{deftn}" where {state_col} in ('conflict')
@@ -718,6 +1014,8 @@ class OdkxLocalTable(object):
 
         staging_tn = self.tableId + '_' + source_prefix + '_staging'
         def_tn = self.tableId + '_' + source_prefix
+        self._storage.addIndex(def_tn, [external_id_column])
+        self._storage.addIndex(staging_tn, [external_id_column])
         self._copyMissingData(self.tableId, def_tn)
         self.fillHashColumn(def_tn)
 
@@ -735,7 +1033,7 @@ class OdkxLocalTable(object):
             c.execute(qry.format(schema=self.schema, stagingtable=staging_tn, realtable=def_tn, extid=external_id_column))
             c.execute(qry.format(schema=self.schema, stagingtable=staging_tn, realtable=self.tableId, extid=external_id_column))
 
-        self.fillHashColumn(staging_tn)
+        self.fillHashColumn(staging_tn, incremental=False)
         qry = """
             UPDATE {schema}."{stagingtable}" set "rowETag" = {schema}."{realtable}"."rowETag", state='unchanged'
             FROM {schema}."{realtable}" WHERE {schema}."{stagingtable}".id = {schema}."{realtable}".id AND
@@ -799,6 +1097,7 @@ class OdkxLocalTable(object):
                          $$;
                          """.format(schema=self.schema, tableId=self.tableId, history_nb=historyPrefix)
             self._safeSql(sql, trans)
+            self._storage._invalidateTableMeta(prefix=self.tableId)
             if deleteOldTables:
                 self.updateLocalStatusDb(None, trans)
                 remoteTable.deleteTable(True)
@@ -845,6 +1144,8 @@ class OdkxLocalTable(object):
             with self.engine.begin() as con:
                 con.execute("""ALTER TABLE {schema}."{table}" ADD COLUMN state_upload VARCHAR;
                       """.format(schema=self.schema, table=table))
+            self._storage._invalidateTableMeta(table)
+        self._storage.ensureIndex(table, ['state_upload'])
 
     def uploadHistory(self, remoteTable: OdkxServerTable, historyTable: str = None, mapping: dict = None):
         """
@@ -0,0 +1,109 @@
+"""
+Incremental multipart parser
+the body of every part is passed to a writer while it arrives, so the memory use is bounded by the chunk size and not by the size of the parts
+"""
+import re
+from typing import Any, Callable, Dict, Iterable
+
+_PREAMBLE, _DELIMITER, _HEADERS, _BODY, _DONE = range(5)
+
+MAX_HEADER_SIZE = 64 * 1024
+
+
+class MultipartParseError(Exception):
+    pass
+
+
+def partFilename(headers: Dict[str, str]) -> str:
+    """
+    the filename of a part, eg Content-Disposition: file;filename="image.jpg"
+    """
+    m = re.search(r'filename="?([^";]+)"?', headers.get('content-disposition', ''))
+    if m is None:
+        raise MultipartParseError("no filename in part headers " + str(headers))
+    return m.group(1)
+
+
+class StreamingMultipartParser(object):
+    """
+    :param content_type: the Content-Type of the multipart response (it contains the boundary)
+    :param on_part: called with the headers of every part (lowercase names), returns an object with write(bytes) and close()
+    """
+    def __init__(self, content_type: str, on_part: Callable[[Dict[str, str]], Any]):
+        m = re.search(r'boundary="?([^";]+)"?', content_type or '')
+        if m is None:
+            raise MultipartParseError("no boundary in content type " + str(content_type))
+        self._delimiter = b"\r\n--" + m.group(1).encode('latin-1')
+        self._on_part = on_part
+        # the first boundary is not preceded by a newline
+        self._buffer = b"\r\n"
+        self._state = _PREAMBLE
+        self._writer = None
+
+    def _parseHeaders(self, raw: bytes) -> Dict[str, str]:
+        headers = {}
+        for line in raw.decode('latin-1').split("\r\n"):
+            if ':' in line:
+                k, v = line.split(':', 1)
+                headers[k.strip().lower()] = v.strip()
+        return headers
+
+    def feed(self, data: bytes):
+        self._buffer += data
+        while True:
+            if self._state == _PREAMBLE:
+                idx = self._buffer.find(self._delimiter)
+                if idx < 0:
+                    self._buffer = self._buffer[-(len(self._delimiter) - 1):]
+                    return
+                self._buffer = self._buffer[idx + len(self._delimiter):]
+                self._state = _DELIMITER
+            elif self._state == _DELIMITER:
+                if len(self._buffer) < 2:
+                    return
+                if self._buffer.startswith(b"--"):
+                    self._buffer = b""
+                    self._state = _DONE
+                    return
+                idx = self._buffer.find(b"\r\n")
+                if idx < 0:
+                    return
+                # ignore transport padding after the boundary
+                self._buffer = self._buffer[idx + 2:]
+                self._state = _HEADERS
+            elif self._state == _HEADERS:
+                idx = self._buffer.find(b"\r\n\r\n")
+                if idx < 0:
+                    if len(self._buffer) > MAX_HEADER_SIZE:
+                        raise MultipartParseError("part headers too large")
+                    return
+                self._writer = self._on_part(self._parseHeaders(self._buffer[:idx]))
+                self._buffer = self._buffer[idx + 4:]
+                self._state = _BODY
+            elif self._state == _BODY:
+                idx = self._buffer.find(self._delimiter)
+                if idx < 0:
+                    # keep what could be the start of a delimiter
+                    safe = len(self._buffer) - (len(self._delimiter) - 1)
+                    if safe > 0:
+                        self._writer.write(self._buffer[:safe])
+                        self._buffer = self._buffer[safe:]
+                    return
+                self._writer.write(self._buffer[:idx])
+                self._writer.close()
+                self._writer = None
+                self._buffer = self._buffer[idx + len(self._delimiter):]
+                self._state = _DELIMITER
+            else:
+                self._buffer = b""
+                return
+
+    def finish(self):
+        if self._state != _DONE:
+            raise MultipartParseError("multipart body ended prematurely")
+
+    def parse(self, chunks: Iterable[bytes]):
+        for chunk in chunks:
+            if chunk:
+                self.feed(chunk)
+        self.finish()
@@ -0,0 +1,88 @@
+"""
+Prefetch rowset pages in a background thread so fetching the next page overlaps with writing the current one
+"""
+import threading
+import contextvars
+from collections import deque
+from typing import Iterable, Iterator, Optional
+from .odkx_server_table import OdkxServerTableRowset
+
+
+class RowsetPrefetcher(object):
+    """
+    iterates over a rowset generator (eg OdkxServerTable.getDiffGenerator) that is consumed by a background producer thread.
+
+    :param rowsets: the generator to consume
+    :param max_pages: maximum number of pages waiting in the queue
+    :param max_rows: maximum number of rows waiting in the queue (None is unlimited). a single page bigger than this is still accepted
+        when the queue is empty, so the limit should be at least the fetchLimit of the generator to be effective
+    """
+    def __init__(self, rowsets: Iterable[OdkxServerTableRowset], max_pages: int = 2, max_rows: Optional[int] = None):
+        if max_pages < 1:
+            raise ValueError("max_pages should be at least 1")
+        self._rowsets = rowsets
+        self.max_pages = max_pages
+        self.max_rows = max_rows
+        self._pages = deque()
+        self._rows = 0
+        self._done = False
+        self._closed = False
+        self._error = None
+        self._cond = threading.Condition()
+        # the producer runs in a copy of the creator's context, so its requests count in the bytes of the creator's SyncReport phase
+        self._thread = threading.Thread(target=contextvars.copy_context().run, args=(self._produce,), name="odkxpy-prefetch", daemon=True)
+
+    def _full(self, nrows: int) -> bool:
+        if not self._pages:
+            return False
+        if len(self._pages) >= self.max_pages:
+            return True
+        return self.max_rows is not None and self._rows + nrows > self.max_rows
+
+    def _produce(self):
+        try:
+            for rs in self._rowsets:
+                nrows = len(rs.rows)
+                with self._cond:
+                    while not self._closed and self._full(nrows):
+                        self._cond.wait()
+                    if self._closed:
+                        return
+                    self._pages.append(rs)
+                    self._rows += nrows
+                    self._cond.notify_all()
+        except BaseException as e:
+            self._error = e
+        finally:
+            with self._cond:
+                self._done = True
+                self._cond.notify_all()
+
+    def close(self):
+        """
+        stop the producer (it finishes the request it is doing, but will not fetch any more pages)
+        """
+        with self._cond:
+            self._closed = True
+            self._pages.clear()
+            self._rows = 0
+            self._cond.notify_all()
+
+    def __iter__(self) -> Iterator[OdkxServerTableRowset]:
+        self._thread.start()
+        try:
+            while True:
+                with self._cond:
+                    while not self._pages and not self._done:
+                        self._cond.wait()
+                    if self._pages:
+                        rs = self._pages.popleft()
+                        self._rows -= len(rs.rows)
+                        self._cond.notify_all()
+                    elif self._error is not None:
+                        raise self._error
+                    else:
+                        return
+                yield rs
+        finally:
+            self.close()
@@ -0,0 +1,65 @@
+"""
+Progress of the pull of a table, so an interrupted pull continues from the last page written to staging
+the checkpoint is written in the same transaction as the page it describes
+"""
+import sqlalchemy
+from collections import namedtuple
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from typing import Optional, TYPE_CHECKING
+if TYPE_CHECKING:
+    from .local_storage_sql import SqlLocalStorage
+
+PullCheckpointState = namedtuple('PullCheckpointState', [
+    'mode', 'schemaETag', 'startDataETag', 'firstDataETag', 'lastDataETag', 'cursor', 'pages', 'stagedRows', 'complete'
+])
+
+
+def checkpoint_class(base):
+    class PullCheckpoint(base):
+        __tablename__ = "odkxpy_pull_checkpoint"
+        tableId = sqlalchemy.Column(sqlalchemy.String, primary_key=True)
+        mode = sqlalchemy.Column(sqlalchemy.String(20))
+        schemaETag = sqlalchemy.Column(sqlalchemy.String)
+        startDataETag = sqlalchemy.Column(sqlalchemy.String)
+        firstDataETag = sqlalchemy.Column(sqlalchemy.String)
+        lastDataETag = sqlalchemy.Column(sqlalchemy.String)
+        cursor = sqlalchemy.Column(sqlalchemy.Text)
+        pages = sqlalchemy.Column(sqlalchemy.Integer)
+        # rows in staging when the checkpoint was written, staging can lose them (eg an UNLOGGED table after a crash)
+        stagedRows = sqlalchemy.Column(sqlalchemy.BigInteger)
+        complete = sqlalchemy.Column(sqlalchemy.Boolean)
+
+    return PullCheckpoint
+
+
+class PullCheckpoint(object):
+    """
+    the pull checkpoint of one table, stored in the local schema.
+
+    :param storage: the local storage (the checkpoint table is created in its schema)
+    :param tableId: the table being pulled
+    """
+    def __init__(self, storage: "SqlLocalStorage", tableId: str):
+        self.engine = storage.engine
+        self.tableId = tableId
+        self.Checkpoint = checkpoint_class(storage.declarative_base())
+        self.Checkpoint.__table__.create(bind=self.engine, checkfirst=True)
+
+    def get(self) -> Optional[PullCheckpointState]:
+        t = self.Checkpoint.__table__
+        with self.engine.connect() as c:
+            r = c.execute(sqlalchemy.select([t.c[x] for x in PullCheckpointState._fields]).where(t.c.tableId == self.tableId)).first()
+        if r is None:
+            return None
+        return PullCheckpointState(*r)
+
+    def save(self, connection: sqlalchemy.engine.Connection, state: PullCheckpointState):
+        t = self.Checkpoint.__table__
+        values = state._asdict()
+        qry = pg_insert(t).values(tableId=self.tableId, **values)
+        qry = qry.on_conflict_do_update(index_elements=[t.c.tableId], set_=values)
+        connection.execute(qry)
+
+    def clear(self, connection: sqlalchemy.engine.Connection):
+        t = self.Checkpoint.__table__
+        connection.execute(t.delete().where(t.c.tableId == self.tableId))
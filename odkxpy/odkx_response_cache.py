@@ -0,0 +1,116 @@
+"""
+Cache of server responses for OdkxConnection.GET, revalidated with If-None-Match / If-Modified-Since
+only documents that rarely change are cached (definitions, properties, manifests, files), table definitions
+(tables/[tableId]/ref/[schemaETag]) never change and are not revalidated at all
+"""
+import os
+import re
+import json
+import hashlib
+import sqlalchemy
+from collections import namedtuple
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from typing import Optional, TYPE_CHECKING
+if TYPE_CHECKING:
+    from .local_storage_sql import SqlLocalStorage
+
+ResponseCacheEntry = namedtuple('ResponseCacheEntry', ['etag', 'lastModified', 'body', 'immutable'])
+
+# urls relative to the app root
+CACHEABLE_URLS = [
+    re.compile(r'^tables/[^/]+/ref/[^/]+$'),
+    re.compile(r'^tables/[^/]+/properties/2$'),
+    re.compile(r'^manifest/2/[^/]*$'),
+    re.compile(r'^files/2/'),
+]
+IMMUTABLE_URLS = [
+    re.compile(r'^tables/[^/]+/ref/[^/]+$'),
+]
+
+
+class ResponseCache(object):
+    """
+    base class of the cache backends, they implement get and put
+    """
+    def cacheable(self, url: str) -> bool:
+        return any(p.match(url) for p in CACHEABLE_URLS)
+
+    def immutable(self, url: str) -> bool:
+        return any(p.match(url) for p in IMMUTABLE_URLS)
+
+    def get(self, key: str) -> Optional[ResponseCacheEntry]:
+        raise NotImplementedError()
+
+    def put(self, key: str, entry: ResponseCacheEntry):
+        raise NotImplementedError()
+
+
+class FileResponseCache(ResponseCache):
+    """
+    one json file per cached response
+
+    :param path: the cache directory (created when missing)
+    """
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def _filename(self, key: str) -> str:
+        return os.path.join(self.path, hashlib.sha256(key.encode('utf-8')).hexdigest() + '.json')
+
+    def get(self, key: str) -> Optional[ResponseCacheEntry]:
+        try:
+            with open(self._filename(key), 'r', encoding='utf-8') as f:
+                d = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if d.get('key') != key:
+            return None
+        return ResponseCacheEntry(d['etag'], d['lastModified'], d['body'], d['immutable'])
+
+    def put(self, key: str, entry: ResponseCacheEntry):
+        fn = self._filename(key)
+        tmp = fn + '-tmp' + str(os.getpid())
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(dict(entry._asdict(), key=key), f)
+        os.replace(tmp, fn)
+
+
+def responsecache_class(base):
+    class CachedResponse(base):
+        __tablename__ = "odkxpy_cached_responses"
+        key = sqlalchemy.Column(sqlalchemy.Text, primary_key=True)
+        etag = sqlalchemy.Column(sqlalchemy.Text)
+        lastModified = sqlalchemy.Column(sqlalchemy.Text)
+        body = sqlalchemy.Column(sqlalchemy.Text)
+        immutable = sqlalchemy.Column(sqlalchemy.Boolean)
+
+    return CachedResponse
+
+
+class SqlResponseCache(ResponseCache):
+    """
+    cached responses in the odkxpy_cached_responses table of the local schema
+
+    :param storage: the local storage (the cache table is created in its schema)
+    """
+    def __init__(self, storage: "SqlLocalStorage"):
+        self.engine = storage.engine
+        self.CachedResponse = responsecache_class(storage.declarative_base())
+        self.CachedResponse.__table__.create(bind=self.engine, checkfirst=True)
+
+    def get(self, key: str) -> Optional[ResponseCacheEntry]:
+        t = self.CachedResponse.__table__
+        with self.engine.connect() as c:
+            r = c.execute(sqlalchemy.select([t.c.etag, t.c.lastModified, t.c.body, t.c.immutable]).where(t.c.key == key)).first()
+        if r is None:
+            return None
+        return ResponseCacheEntry(*r)
+
+    def put(self, key: str, entry: ResponseCacheEntry):
+        t = self.CachedResponse.__table__
+        values = entry._asdict()
+        qry = pg_insert(t).values(key=key, **values)
+        qry = qry.on_conflict_do_update(index_elements=[t.c.key], set_=values)
+        with self.engine.begin() as c:
+            c.execute(qry)
@@ -0,0 +1,124 @@
+"""
+Conversion of rows between the server representation and local records
+everything that only depends on the table definition is resolved once per schemaETag
+"""
+import datetime
+from typing import Dict, Sequence, Tuple
+from .odkx_server_table import OdkxServerTableDefinition, OdkxServerTableRow
+
+ACCESS_COLUMNS = ('defaultAccess', 'groupModify', 'groupPrivileged', 'groupReadOnly', 'rowOwner')
+
+FIX_ROW_FIELDS = ('createUser', 'lastUpdateUser', 'dataETagAtModification', 'rowETag', 'savepointCreator',
+                  'formId', 'locale', 'savepointType', 'savepointTimestamp', 'deleted', 'id')
+
+USER_FIELDS = ('createUser', 'lastUpdateUser', 'savepointCreator')
+
+_ROW, _SCOPE, _CELL = range(3)
+
+
+class OdkxRowConverter(object):
+    """
+    :param definition: the table definition the rows belong to
+    """
+    def __init__(self, definition: OdkxServerTableDefinition):
+        self.schemaETag = definition.schemaETag
+        self.datacols = tuple(definition.columnsKeyList)
+        # for every column layout of the local rows: (data columns to send, fixed fields present)
+        self._plans: Dict[Tuple[Tuple[str, ...], bool], Tuple[Tuple[str, ...], Tuple[str, ...]]] = {}
+        # for every local column order: where to find each column in a raw server row (see asvalues)
+        self._rawPlans: Dict[Tuple[str, ...], Tuple[Tuple[int, str], ...]] = {}
+
+    def asdict(self, r: OdkxServerTableRow) -> dict:
+        """
+        server row to a dict keyed by local column name
+        """
+        fs = r.filterScope
+        dct = {
+            'rowETag': r.rowETag,
+            'createUser': r.createUser,
+            'lastUpdateUser': r.lastUpdateUser,
+            'dataETagAtModification': r.dataETagAtModification,
+            'savepointCreator': r.savepointCreator,
+            'formId': r.formId,
+            'locale': r.locale,
+            'savepointType': r.savepointType,
+            'savepointTimestamp': r.savepointTimestamp,
+            'deleted': r.deleted,
+            'defaultAccess': fs.defaultAccess,
+            'groupModify': fs.groupModify,
+            'groupPrivileged': fs.groupPrivileged,
+            'groupReadOnly': fs.groupReadOnly,
+            'rowOwner': fs.rowOwner,
+            'id': r.id,
+        }
+        # orderedColumns are (column, value) pairs
+        dct.update(r.orderedColumns)
+        return dct
+
+    def _rawPlan(self, columns: Sequence[str]) -> Tuple[Tuple[int, str], ...]:
+        key = tuple(columns)
+        plan = self._rawPlans.get(key)
+        if plan is None:
+            plan = tuple((_ROW if c in FIX_ROW_FIELDS else _SCOPE if c in ACCESS_COLUMNS else _CELL, c) for c in key)
+            self._rawPlans[key] = plan
+        return plan
+
+    def checkRawColumns(self, r: dict, columns: Sequence[str]):
+        """
+        raise when a raw server row has data columns that are not in columns
+        """
+        unknown = [c['column'] for c in r['orderedColumns'] if c['column'] not in columns]
+        if unknown:
+            raise Exception("schema's have diverged: got column(s) {c} but i couldn't find them locally. please fix.".format(c=",".join(unknown)))
+
+    def asvalues(self, r: dict, columns: Sequence[str]) -> tuple:
+        """
+        raw server row (json dict, see OdkxServerTable.getDiff(raw=True)) to a tuple with the values of columns, in that order
+        """
+        sources = (r, r.get('filterScope') or {}, {c['column']: c['value'] for c in r['orderedColumns']})
+        return tuple(sources[k].get(c) for k, c in self._rawPlan(columns))
+
+    def _plan(self, keys: Sequence[str], full: bool) -> Tuple[Tuple[str, ...], Tuple[str, ...]]:
+        plan_key = (tuple(keys), full)
+        plan = self._plans.get(plan_key)
+        if plan is None:
+            keyset = set(keys)
+            if full:
+                for c in self.datacols:
+                    if not c in keyset:
+                        raise Exception("schema's have diverged: on ODKX server i got column {c} but i couldn't find it locally. please fix.".format(c=c))
+                datacols = self.datacols
+            else:
+                datacols = tuple(c for c in self.datacols if c in keyset)
+            plan = (datacols, tuple(k for k in keys if k in FIX_ROW_FIELDS))
+            self._plans[plan_key] = plan
+        return plan
+
+    def asrecord(self, row, default_user: str, full: bool = True) -> dict:
+        """
+        local row (anything with keys() and item access, eg a sqlalchemy RowProxy) to the json record expected by alterDataRows
+
+        :param full: when True every data column of the definition must be present in the row
+        """
+        datacols, fixcols = self._plan(row.keys(), full)
+        filterScope = {c: row[c] for c in ACCESS_COLUMNS}
+        if filterScope['defaultAccess'] is None:
+            filterScope['defaultAccess'] = 'FULL'
+
+        result = {
+            'filterScope': filterScope,
+            'orderedColumns': [{'column': c, 'value': row[c]} for c in datacols],
+        }
+        for k in fixcols:
+            v = row[k]
+            if k == 'savepointTimestamp':
+                if v is None:
+                    v = str(datetime.datetime.now())
+                elif isinstance(v, datetime.datetime):
+                    v = str(v)
+            elif k == 'savepointType' and v is None:
+                v = 'COMPLETE'
+            elif k in USER_FIELDS and v is None:
+                v = default_user
+            result[k] = v
+        return result
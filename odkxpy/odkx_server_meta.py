@@ -1,6 +1,6 @@
 import json
 from .odkx_connection import OdkxConnection
-from .odkx_server_table import OdkxServerTable
+from .odkx_server_table import OdkxServerTable, OdkxServerTableInfo
 from collections import namedtuple
 
 from .odkx_server_file import OdkxServerFile
@@ -47,6 +47,12 @@ class OdkxServerMeta(object):
     def getTables(self):
         return [ OdkxServerTable(self.connection, x['tableId'], x['schemaETag']) for x in  self.connection.GET("tables")['tables'] ]
 
+    def getTablesInfo(self):
+        """
+        the info (dataETag, schemaETag, ...) of all tables, in one request
+        """
+        return [ OdkxServerTableInfo(**x) for x in self.connection.GET("tables")['tables'] ]
+
     def getTable(self, tableId: str):
         table = next((table for table in self.getTables() if table.tableId == tableId), None)
         if table:
@@ -5,7 +5,7 @@ from collections import namedtuple
 from .odkx_connection import OdkxConnection
 import datetime
 import logging
-from typing import List, Generator, NamedTuple, Union, Sequence, Callable
+from typing import List, Generator, NamedTuple, Union, Sequence, Callable, BinaryIO
 from requests_toolbelt import MultipartEncoder
 
 OdkxServerTableInfo = namedtuple('OdkxServerTableInfo', [
@@ -171,6 +171,36 @@ class OdkxServerTableDefinition():
 
         return OdkxServerTableDefinition(obj["schemaETag"], obj["tableId"],deflist)
 
+    @classmethod
+    def _from_server(cls, tableId, t_d, properties) -> "OdkxServerTableDefinition":
+        """
+        :param t_d: the response of tables/[tableId]/ref/[schemaETag]
+        :param properties: the response of tables/[tableId]/properties/2
+        """
+        col_props = [x for x in properties if x['partition'] == 'Column']
+        etag = t_d["schemaETag"]
+
+        cols = {}
+        for c in t_d['orderedColumns']:
+            dd = {}
+            dd.update(c)
+            del dd['listChildElementKeys']
+            cd = OdkxServerColumnDefinition(**dd)
+            cd.childElements = []
+            for prop in [x for x in col_props if x['aspect'] == cd.elementKey]:
+                cd.properties[prop['key']] = prop['value']
+
+            cols[cd.elementKey] = cd
+        for c in t_d['orderedColumns']:
+            children = json.loads(c['listChildElementKeys'])
+            parent = cols[c['elementKey']]
+            for c in children:
+                cols[c].parentElement = parent
+                parent.childElements.append(cols[c])
+        deflist = [cols[x['elementKey']] for x in t_d['orderedColumns']]
+
+        return OdkxServerTableDefinition(etag, tableId, deflist)
+
     @classmethod
     def _from_DefFile(cls, tableId, colList) -> "OdkxServerTableDefinition":
         colList.pop(0)
@@ -240,31 +270,8 @@ class OdkxServerTable(object):
 
     def getTableDefinition(self) -> OdkxServerTableDefinition:
         t_d = self.connection.GET(self.getTableDefinitionRoot())
-        col_props = [x for x in self.connection.GET(
-            "tables/" + self.tableId + "/properties/2") if x['partition'] == 'Column']
-        etag = t_d["schemaETag"]
-        t_id = self.tableId
-
-        cols = {}
-        for c in t_d['orderedColumns']:
-            dd = {}
-            dd.update(c)
-            del dd['listChildElementKeys']
-            cd = OdkxServerColumnDefinition(**dd)
-            cd.childElements = []
-            for prop in [x for x in col_props if x['aspect'] == cd.elementKey]:
-                cd.properties[prop['key']] = prop['value']
-
-            cols[cd.elementKey] = cd
-        for c in t_d['orderedColumns']:
-            children = json.loads(c['listChildElementKeys'])
-            parent = cols[c['elementKey']]
-            for c in children:
-                cols[c].parentElement = parent
-                parent.childElements.append(cols[c])
-        deflist = [cols[x['elementKey']] for x in t_d['orderedColumns']]
-
-        return OdkxServerTableDefinition(etag, t_id, deflist)
+        properties = self.connection.GET("tables/" + self.tableId + "/properties/2")
+        return OdkxServerTableDefinition._from_server(self.tableId, t_d, properties)
 
     def deleteTable(self, are_you_sure: bool):
         """To delete a table
@@ -282,12 +289,18 @@ class OdkxServerTable(object):
     def getTableAcl(self):
         return self.connection.GET('tables/' + self.tableId + '/acl')
 
-    def _parse_rowset(self, r):
-        r['rows'] = [self._parse_row(x) for x in r['rows']]
+    @staticmethod
+    def _parse_rowset(r, raw=False):
+        """
+        :param raw: keep the rows as the json dicts of the server instead of OdkxServerTableRow
+        """
+        if not raw:
+            r['rows'] = [OdkxServerTable._parse_row(x) for x in r['rows']]
         d = OdkxServerTableRowset(**r)
         return d
 
-    def _parse_row(self, r):
+    @staticmethod
+    def _parse_row(r):
         def rw(x):
             x['orderedColumns'] = [OdkxServerTableColumn(
                 **z) for z in x['orderedColumns']]
@@ -296,32 +309,35 @@ class OdkxServerTable(object):
             return x
         return OdkxServerTableRow(**rw(r))
 
-    def _generator_rowset(self, l) -> Generator[OdkxServerTableRowset, None, None]:
+    def _generator_rowset(self, l, cursor=None) -> Generator[OdkxServerTableRowset, None, None]:
         hasmore = True
-        cursor = None
         while hasmore:
             rs = l(cursor)
             hasmore = rs.hasMoreResults
             cursor = rs.webSafeResumeCursor
             yield rs
 
-    def getDiffGenerator(self, dataETag=None, fetchLimit=None, getFullLog=False) -> Generator[OdkxServerTableRowset, None, None]:
+    def getDiffGenerator(self, dataETag=None, fetchLimit=None, getFullLog=False, cursor=None, raw=False) -> Generator[OdkxServerTableRowset, None, None]:
+        """
+        :param cursor: start from this webSafeResumeCursor instead of the first page
+        :param raw: keep the rows as the json dicts of the server (see _parse_rowset)
+        """
         return self._generator_rowset(
-            lambda z_cursor: self.getDiff(dataETag=dataETag, cursor=z_cursor, fetchLimit=fetchLimit, getFullLog=getFullLog))
+            lambda z_cursor: self.getDiff(dataETag=dataETag, cursor=z_cursor, fetchLimit=fetchLimit, getFullLog=getFullLog, raw=raw), cursor)
 
-    def getDiff(self, dataETag=None, cursor=None, fetchLimit=None, getFullLog=False) -> OdkxServerTableRowset:
+    def getDiff(self, dataETag=None, cursor=None, fetchLimit=None, getFullLog=False, raw=False) -> OdkxServerTableRowset:
         params = {'data_etag': dataETag,
                   'cursor': cursor, 'fetchLimit': fetchLimit, 'getFullLog': getFullLog}
         r = self.connection.GET(self.getTableDefinitionRoot() + "/diff", params)
-        return self._parse_rowset(r)
+        return self._parse_rowset(r, raw)
 
-    def getAllDataRowsGenerator(self, fetchLimit=None) -> Generator[OdkxServerTableRowset, None, None]:
+    def getAllDataRowsGenerator(self, fetchLimit=None, cursor=None, raw=False) -> Generator[OdkxServerTableRowset, None, None]:
         return self._generator_rowset(
-            lambda z_cursor: self.getAllDataRows(cursor=z_cursor, fetchLimit=fetchLimit))
+            lambda z_cursor: self.getAllDataRows(cursor=z_cursor, fetchLimit=fetchLimit, raw=raw), cursor)
 
-    def getAllDataRows(self, cursor=None, fetchLimit=None) -> OdkxServerTableRowset:
+    def getAllDataRows(self, cursor=None, fetchLimit=None, raw=False) -> OdkxServerTableRowset:
         params = {'cursor': cursor, 'fetchLimit': fetchLimit}
-        return self._parse_rowset(self.connection.GET(self.getTableDefinitionRoot() + "/rows", params))
+        return self._parse_rowset(self.connection.GET(self.getTableDefinitionRoot() + "/rows", params), raw)
 
     def getChangesets(self, dataETag=None, sequence_value=None):
         # Not working - Problem API ?
@@ -348,40 +364,35 @@ class OdkxServerTable(object):
     # I GOT HERE REFACTORING
 
     def getAttachment(self, rowId, name, stream, timeout):
-        return self.connection.session.get(
-            self.connection.server + self.connection.appID + '/' +
-            self.getTableDefinitionRoot() + "/attachments/" + rowId + "/file/" + name,
-            stream=stream, timeout=timeout)
+        return self.connection.request('GET', self.getTableDefinitionRoot() + "/attachments/" + rowId + "/file/" + name,
+                                       stream=stream, timeout=timeout)
 
-    def getAttachments(self, rowId: str, manifest: Sequence[OdkxServerFile]):
+    def getAttachments(self, rowId: str, manifest: Sequence[OdkxServerFile], stream: bool = False):
         payload = OdkxServerFileManifest(manifest).asdict()
-        return self.connection.session.post(
-            self.connection.server + self.connection.appID + '/' + self.getTableDefinitionRoot() + "/attachments/" +
-            rowId + "/download",
-            json=payload)
+        return self.connection.request('POST', self.getTableDefinitionRoot() + "/attachments/" + rowId + "/download",
+                                       json=payload, stream=stream)
 
     def putAttachment(self, rowId, name, data):
         headers = {"Content-Type": "application/octet-stream"}
-        return self.connection.session.post(
-            self.connection.server + self.connection.appID + '/' + self.getTableDefinitionRoot() + "/attachments/" +
-            rowId + "/file/" + name,
-            headers=headers, data=data)
+        return self.connection.request('POST', self.getTableDefinitionRoot() + "/attachments/" + rowId + "/file/" + name,
+                                       headers=headers, data=data)
 
-    def putAttachments(self, rowId, manifest: Sequence["OdkxLocalFile"], data: List[bytes]):
+    def putAttachments(self, rowId, manifest: Sequence["OdkxLocalFile"], data: List[Union[bytes, BinaryIO]]):
         """
         :param manifest: ex. FilesystemAttachmentStore().getManifest(rowId)
-        :param data: list of byte arrays
+        :param data: list of byte arrays or open binary files. files are streamed, the caller closes them afterwards
         """
         fields = {f"{srv.filename}": (f"{srv.filename}", d,
                                       srv.contentType or "image/jpg", {"Name": "file"}) for srv, d in zip(manifest, data)}
         multi_image = MultipartEncoder(fields=fields)
         for part in multi_image.parts:
             # this is fix for odkx-sync-endpoint using custom content disposition "file"
-            part.headers = part.headers.replace(b"form-data;", b"file;")
-        #didn't get it to work as stream
-        payload = multi_image.to_string()
+            headers = part.headers.replace(b"form-data;", b"file;")
+            # the part length (used for the Content-Length of the stream) was computed with the original headers
+            part.len += len(headers) - len(part.headers)
+            part.headers = headers
         return self.connection.POST(self.getTableDefinitionRoot() + "/attachments/" +
-            rowId + "/upload", data=payload, headers={"Content-Type": multi_image.content_type})
+            rowId + "/upload", data=multi_image, headers={"Content-Type": multi_image.content_type})
 
 
     def alterDataRows(self, json):
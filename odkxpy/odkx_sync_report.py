@@ -0,0 +1,101 @@
+"""
+Wall time, rows and bytes of every phase of OdkxLocalTable.sync, with optional cProfile / tracemalloc per phase
+"""
+import time
+import cProfile
+import pstats
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+from typing import Dict, Optional
+from .odkx_instrumentation import countBytes
+
+PHASES = ('manifest', 'definition', 'staging', 'merge', 'log', 'push', 'conflicts', 'attachments')
+
+
+class PhaseStats(object):
+    __slots__ = ('seconds', 'rows', 'bytes', 'calls', 'memoryPeak', 'profile')
+
+    def __init__(self):
+        self.seconds = 0.0
+        self.rows = 0
+        self.bytes = 0
+        self.calls = 0
+        # only filled in when profiling
+        self.memoryPeak: Optional[int] = None
+        self.profile: Optional[pstats.Stats] = None
+
+    def asdict(self) -> dict:
+        return {'seconds': self.seconds, 'rows': self.rows, 'bytes': self.bytes, 'calls': self.calls, 'memoryPeak': self.memoryPeak}
+
+
+class SyncReport(object):
+    """
+    returned by OdkxLocalTable.sync. phases are timed on the calling thread and should not be nested.
+
+    :param tableId: the synced table
+    :param metrics: the RequestMetrics of the connection, to count the bytes sent and received during each phase
+        (only the requests of the calling thread and of the attachment workers it starts, not those of other syncs running at the same time)
+    :param profile: run every phase under cProfile (phases[name].profile, a pstats.Stats of the calling thread)
+    :param trace_memory: record the peak memory allocated by python during every phase with tracemalloc (phases[name].memoryPeak).
+        tracemalloc is process wide: the peak includes the allocations of all threads, so only use it when nothing else runs.
+        before python 3.9 the peak cannot be reset, a phase then reports the highest peak since tracing started
+    """
+    def __init__(self, tableId: str, metrics=None, profile: bool = False, trace_memory: bool = False):
+        self.tableId = tableId
+        self.metrics = metrics
+        self.profile = profile
+        self.trace_memory = trace_memory
+        self.phases: Dict[str, PhaseStats] = {p: PhaseStats() for p in PHASES}
+        self.started = time.time()
+        self.seconds = 0.0
+
+    @contextmanager
+    def phase(self, name: str):
+        stats = self.phases.setdefault(name, PhaseStats())
+        profiler = cProfile.Profile() if self.profile else None
+        started_tracing = False
+        if self.trace_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                started_tracing = True
+            if hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+            memory_before = tracemalloc.get_traced_memory()[0]
+        counter = None
+        start = time.perf_counter()
+        if profiler is not None:
+            profiler.enable()
+        try:
+            with (countBytes() if self.metrics is not None else nullcontext()) as counter:
+                yield stats
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                if stats.profile is None:
+                    stats.profile = pstats.Stats(profiler)
+                else:
+                    stats.profile.add(profiler)
+            stats.seconds += time.perf_counter() - start
+            stats.calls += 1
+            if counter is not None:
+                stats.bytes += counter.sent + counter.received
+            if self.trace_memory:
+                peak = tracemalloc.get_traced_memory()[1] - memory_before
+                stats.memoryPeak = max(stats.memoryPeak or 0, peak)
+                if started_tracing:
+                    tracemalloc.stop()
+            self.seconds = time.time() - self.started
+
+    def addRows(self, name: str, rows: int):
+        self.phases.setdefault(name, PhaseStats()).rows += rows
+
+    def asdict(self) -> dict:
+        return {'tableId': self.tableId, 'seconds': self.seconds, 'phases': {k: v.asdict() for k, v in self.phases.items()}}
+
+    def __str__(self):
+        lines = ['sync of {t}: {s:.2f}s'.format(t=self.tableId, s=self.seconds)]
+        for name, stats in self.phases.items():
+            if stats.calls == 0 and stats.rows == 0:
+                continue
+            lines.append('  {n:<12} {s:8.2f}s {r:8d} rows {b:12d} bytes'.format(n=name, s=stats.seconds, r=stats.rows, b=stats.bytes))
+        return '\n'.join(lines)
@@ -7,4 +7,7 @@ setup(
     install_requires=[
         'pandas', 'suds-jurko', 'requests', 'sqlalchemy', 'requests-toolbelt'
     ],
+    extras_require={
+        'async': ['aiohttp'],
+    },
 )
@@ -0,0 +1,154 @@
+"""
+AsyncOdkxConnection / AsyncOdkxServerTable against a small stand-in of the sync endpoint
+"""
+import asyncio
+import pytest
+
+web = pytest.importorskip("aiohttp.web")
+from aiohttp.test_utils import TestServer
+from odkxpy.odkx_async import AsyncOdkxConnection, AsyncOdkxServerMeta
+from odkxpy.odkx_server_file import OdkxServerFile
+
+ROOT = '/odktables/default/'
+TABLE = ROOT + 'tables/t/ref/s'
+ATTACHMENT = b'0123456789' * 10000
+
+
+def _row(id):
+    return {'rowETag': 'e' + id, 'dataETagAtModification': 'd', 'deleted': False, 'createUser': None, 'lastUpdateUser': None,
+            'formId': None, 'locale': None, 'savepointType': 'COMPLETE', 'savepointTimestamp': None, 'savepointCreator': None,
+            'orderedColumns': [{'column': 'x', 'value': id}], 'selfUri': None, 'id': id,
+            'filterScope': {'defaultAccess': 'FULL', 'rowOwner': None, 'groupReadOnly': None, 'groupModify': None,
+                            'groupPrivileged': None}}
+
+
+def _rowset(request, dataETag):
+    # three pages of one row, the cursor is the number of the next page
+    page = int(request.query.get('cursor', '0'))
+    return web.json_response({'rows': [_row(str(page))], 'dataETag': dataETag, 'tableUri': None, 'webSafeRefetchCursor': None,
+                              'webSafeBackwardCursor': None, 'webSafeResumeCursor': str(page + 1),
+                              'hasMoreResults': page < 2, 'hasPriorResults': page > 0})
+
+
+def _app(calls):
+    async def tables(request):
+        return web.json_response({'tables': [{'tableId': 't', 'schemaETag': 's', 'dataETag': 'd'}]})
+
+    async def definition(request):
+        return web.json_response({'schemaETag': 's', 'tableId': 't', 'orderedColumns': [
+            {'elementKey': 'x', 'elementName': 'x', 'elementType': 'string', 'listChildElementKeys': '[]'}]})
+
+    async def properties(request):
+        return web.json_response([{'partition': 'Column', 'aspect': 'x', 'key': 'displayName', 'value': 'X'}])
+
+    async def diff(request):
+        calls.append(('diff', dict(request.query)))
+        return _rowset(request, 'd')
+
+    async def rows(request):
+        calls.append(('rows', dict(request.query)))
+        return _rowset(request, 'd')
+
+    async def alter(request):
+        calls.append(('PUT', await request.json()))
+        return web.json_response({'rows': [], 'dataETag': 'd2'})
+
+    async def put_file(request):
+        calls.append(('POST', request.headers['Content-Type'], await request.read()))
+        return web.Response(status=201)
+
+    async def delete(request):
+        calls.append(('DELETE', request.path))
+        return web.json_response({'deleted': True})
+
+    async def get_file(request):
+        response = web.StreamResponse()
+        await response.prepare(request)
+        for i in range(0, len(ATTACHMENT), 4096):
+            await response.write(ATTACHMENT[i:i + 4096])
+        await response.write_eof()
+        return response
+
+    async def upload(request):
+        reader = await request.multipart()
+        parts = []
+        async for part in reader:
+            parts.append({'disposition': part.headers['Content-Disposition'], 'size': len(await part.read())})
+        calls.append(('upload', parts))
+        return web.Response(status=201)
+
+    app = web.Application()
+    app.router.add_get(ROOT + 'tables', tables)
+    app.router.add_get(TABLE, definition)
+    app.router.add_get(ROOT + 'tables/t/properties/2', properties)
+    app.router.add_get(TABLE + '/diff', diff)
+    app.router.add_get(TABLE + '/rows', rows)
+    app.router.add_put(TABLE + '/rows', alter)
+    app.router.add_post(TABLE + '/attachments/r1/file/a.bin', put_file)
+    app.router.add_get(TABLE + '/attachments/r1/file/a.bin', get_file)
+    app.router.add_post(TABLE + '/attachments/r1/upload', upload)
+    app.router.add_delete(ROOT + 'tables/t', delete)
+    return app
+
+
+def _run(test):
+    async def main():
+        calls = []
+        server = TestServer(_app(calls))
+        await server.start_server()
+        try:
+            async with AsyncOdkxConnection(str(server.make_url('/odktables/')), 'user', 'pwd') as con:
+                await test(con, calls)
+        finally:
+            await server.close()
+    asyncio.run(main())
+
+
+def test_get_definition_and_tables():
+    async def test(con, calls):
+        meta = AsyncOdkxServerMeta(con)
+        assert [x.tableId for x in await meta.getTablesInfo()] == ['t']
+        table = await meta.getTable('t')
+        definition = await table.getTableDefinition()
+        assert definition.columnsKeyList == ['x']
+    _run(test)
+
+
+def test_paging_generators():
+    async def test(con, calls):
+        table = await AsyncOdkxServerMeta(con).getTable('t')
+        pages = [rs async for rs in table.getDiffGenerator(dataETag='d0', fetchLimit=1)]
+        assert [rs.rows[0].id for rs in pages] == ['0', '1', '2']
+        assert [c[1].get('cursor') for c in calls if c[0] == 'diff'] == [None, '1', '2']
+        assert calls[0][1]['data_etag'] == 'd0' and calls[0][1]['fetchLimit'] == '1'
+        raw = [rs async for rs in table.getAllDataRowsGenerator(raw=True)]
+        assert [rs.rows[0]['id'] for rs in raw] == ['0', '1', '2']
+    _run(test)
+
+
+def test_put_post_delete():
+    async def test(con, calls):
+        table = await AsyncOdkxServerMeta(con).getTable('t')
+        assert (await table.alterDataRows({'rows': [], 'dataETag': 'd'}))['dataETag'] == 'd2'
+        await table.putAttachment('r1', 'a.bin', b'abc')
+        assert await con.DELETE('tables/t') == {'deleted': True}
+        assert calls == [('PUT', {'rows': [], 'dataETag': 'd'}), ('POST', 'application/octet-stream', b'abc'),
+                         ('DELETE', ROOT + 'tables/t')]
+    _run(test)
+
+
+def test_streamed_attachments():
+    async def test(con, calls):
+        table = await AsyncOdkxServerMeta(con).getTable('t')
+        chunks = []
+        async with table.openAttachment('r1', 'a.bin') as response:
+            async for chunk in response.content.iter_chunked(1000):
+                chunks.append(chunk)
+        assert b''.join(chunks) == ATTACHMENT
+        assert await asyncio.gather(*[table.getAttachment('r1', 'a.bin') for _ in range(5)]) == [ATTACHMENT] * 5
+        manifest = [OdkxServerFile('a.bin', 3, 'application/octet-stream'), OdkxServerFile('b.bin', 2, None)]
+        await table.putAttachments('r1', manifest, [b'abc', b'de'])
+        parts = calls[-1][1]
+        assert [p['size'] for p in parts] == [3, 2]
+        assert all(p['disposition'].startswith('file;') for p in parts)
+    _run(test)
@@ -0,0 +1,30 @@
+"""
+OdkxBulkLoader: the COPY path and the executemany fallback store the same values
+"""
+import re
+import sqlalchemy
+from odkxpy.odkx_bulk_loader import OdkxBulkLoader
+
+ROWS = [('1', '["a","b"]'), ('2', '[]'), ('3', None), ('4', 'with\ttab\\and backslash')]
+COPY_ESCAPES = {'\\\\': '\\', '\\t': '\t', '\\n': '\n', '\\r': '\r'}
+
+
+def _copy_values(line):
+    # decode one line of COPY text format
+    return [None if v == '\\N' else re.sub(r'\\[\\tnr]', lambda m: COPY_ESCAPES[m.group(0)], v)
+            for v in line.rstrip('\n').split('\t')]
+
+
+def test_copy_and_executemany_store_the_same_array_values():
+    engine = sqlalchemy.create_engine('sqlite://')
+    meta = sqlalchemy.MetaData()
+    table = sqlalchemy.Table('t', meta, sqlalchemy.Column('id', sqlalchemy.String), sqlalchemy.Column('arr', sqlalchemy.types.JSON))
+    meta.create_all(engine)
+    loader = OdkxBulkLoader(table)
+    with engine.begin() as c:
+        loader.loadValues(c, ROWS)
+        stored = [list(r) for r in c.execute('select id, arr from t order by id')]
+    copied = [_copy_values(line) for line in loader._lines(ROWS)]
+    assert copied == stored
+    # the server sends arrays as strings, they are stored as json strings
+    assert copied[0][1] == '"[\\"a\\",\\"b\\"]"'
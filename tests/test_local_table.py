@@ -0,0 +1,31 @@
+"""
+OdkxLocalTable.hasPendingLocalChanges on an external source table
+"""
+import pytest
+import sqlalchemy
+from odkxpy.odkx_local_table import OdkxLocalTable
+
+
+def _localTable(columns, states):
+    engine = sqlalchemy.create_engine('sqlite://')
+    meta = sqlalchemy.MetaData()
+    table = sqlalchemy.Table('t_ext', meta, sqlalchemy.Column('id', sqlalchemy.String), sqlalchemy.Column('state', sqlalchemy.String),
+                             *[sqlalchemy.Column(c, sqlalchemy.String) for c in columns])
+    meta.create_all(engine)
+    engine.execute(table.insert(), [{'id': str(i), 'state': s} for i, s in enumerate(states)])
+    # only the attributes hasPendingLocalChanges uses, a SqlLocalStorage needs postgresql
+    local = OdkxLocalTable.__new__(OdkxLocalTable)
+    local.tableId = 't'
+    local.schema = 'main'
+    local.engine = engine
+    return local
+
+
+@pytest.mark.parametrize('columns,states,pending', [
+    ([], ['synced', 'sync_attachments'], False),
+    (['photo_uriFragment'], ['synced', 'sync_attachments'], True),
+    ([], ['unchanged', 'modified'], True),
+    (['photo_uriFragment'], ['unchanged', 'synced'], False),
+])
+def test_pushed_rows_without_attachment_columns_are_not_pending(columns, states, pending):
+    assert _localTable(columns, states).hasPendingLocalChanges('ext') == pending